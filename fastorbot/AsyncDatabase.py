@@ -0,0 +1,268 @@
+import asyncio
+import concurrent.futures
+import functools
+import random
+
+from fastorbot.Factoid import *
+from fastorbot.FactoidCache import *
+from fastorbot.MetricsRegistry import *
+
+class AsyncDatabase(object):
+    # reader_factory optionally opens a second, read-only connection that queries run on
+    # flush_interval (seconds) is how long changes may wait before being committed when the database batches writes
+    # factoid_cache optionally answers factoid lookups from memory
+    # metrics optionally records how long each database method takes, as "db.<method name>"
+    def __init__(self, database_factory, reader_factory=None, flush_interval=None, factoid_cache=None, metrics=None):
+        # All changes run on one dedicated thread, so the event loop never waits on SQLite and the
+        # connection is only ever used by the thread that created it
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="fastorbot-db")
+        self.database = self.executor.submit(database_factory).result()
+        
+        # Queries get their own thread and connection, so they don't queue up behind a slow commit
+        if reader_factory is not None:
+            self.reader_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="fastorbot-db-reader")
+            self.reader = self.reader_executor.submit(reader_factory).result()
+        else:
+            self.reader_executor = None
+            self.reader = None
+        
+        self.writes_in_flight = 0
+        
+        # Writes that have been queued but may not be committed yet, kept on the event loop's side, since
+        # SQLiteDatabase.pending_writes belongs to the database thread; only needed when the database batches writes
+        self.batches_writes = self.database.write_batch_size is not None
+        self.writes_unflushed = 0
+        
+        self.flush_interval = flush_interval
+        self.flush_handle = None
+        
+        self.factoid_cache = factoid_cache
+        self.metrics = metrics
+    
+    def run_in_executor(self, executor, database, method_name, args):
+        return self.track(self.submit(executor, database, method_name, args), method_name)
+    
+    # Returns the executor's future for a database method, which is only done once the method has finished (or was
+    # cancelled before it started); with metrics on, its result is a tuple (result, seconds taken) for track()
+    def submit(self, executor, database, method_name, args):
+        loop = asyncio.get_event_loop()
+        
+        if self.metrics is None:
+            return loop.run_in_executor(executor, getattr(database, method_name), *args)
+        
+        # The method is timed on the database thread, so the time spent waiting for the thread isn't counted
+        return loop.run_in_executor(executor, MetricsRegistry.timed_call, getattr(database, method_name), *args)
+    
+    # Returns a future for just the result of a future from submit(), recording the time taken
+    def track(self, executor_future, method_name):
+        if self.metrics is None:
+            return executor_future
+        
+        return self.metrics.track_future(executor_future, "db." + method_name)
+    
+    # Run a database method on the database thread, returning an awaitable for its result
+    def call(self, method_name, *args):
+        return self.run_in_executor(self.executor, self.database, method_name, args)
+    
+    # Run a query, on the reader connection when it can see everything the writer has done
+    def read(self, method_name, *args):
+        if (self.reader is None) or (self.writes_in_flight > 0) or (self.writes_unflushed > 0):
+            return self.call(method_name, *args)
+        
+        return self.run_in_executor(self.reader_executor, self.reader, method_name, args)
+    
+    # Run a database method and wait for its result, for use before the event loop starts or after it stops
+    def call_sync(self, method_name, *args):
+        return self.executor.submit(getattr(self.database, method_name), *args).result()
+    
+    # Run a database method that changes data, making sure a batch commit is scheduled for it
+    # Once queued, the change is always made: cancelling the returned future (e.g. when a command times out) only stops
+    # the caller waiting for it
+    def write(self, method_name, *args):
+        executor_future = self.submit(self.executor, self.database, method_name, args)
+        
+        # Until the change is made, only the writer's connection is sure to see it; this is counted on the executor's
+        # future, since it's the only one that isn't done until the method has finished on the database thread
+        self.writes_in_flight += 1
+        executor_future.add_done_callback(self.on_write_done)
+        
+        # ...and once it's made, until it's committed
+        if self.batches_writes:
+            self.writes_unflushed += 1
+        
+        if (self.flush_interval is not None) and (self.flush_handle is None):
+            loop = asyncio.get_event_loop()
+            self.flush_handle = loop.call_later(self.flush_interval, self.flush)
+        
+        # The shield keeps a cancelled caller from cancelling the executor's future, which would drop a write that
+        # hasn't started yet
+        return asyncio.shield(self.track(executor_future, method_name))
+    
+    def on_write_done(self, future):
+        self.writes_in_flight -= 1
+    
+    def flush(self):
+        self.flush_handle = None
+        
+        # The writer runs one method at a time in order, so this commits every write queued before it, but not any
+        # queued after it
+        executor_future = self.submit(self.executor, self.database, "flush", ())
+        executor_future.add_done_callback(functools.partial(self.on_flush_done, self.writes_unflushed))
+        return self.track(executor_future, "flush")
+    
+    # A failed flush leaves its writes counted, so reads keep going to the writer until a later flush commits them
+    def on_flush_done(self, writes_flushed, future):
+        if (not future.cancelled()) and (future.exception() is None):
+            self.writes_unflushed -= writes_flushed
+    
+    # Commits any batched changes before closing
+    def close(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        
+        self.call_sync("close")
+        self.executor.shutdown()
+        
+        if self.reader is not None:
+            self.reader_executor.submit(self.reader.close).result()
+            self.reader_executor.shutdown()
+    
+    # Get a subject's factoids from the cache, loading them on a miss; None if the subject is too large to cache
+    async def get_subject_factoids(self, subject):
+        factoids = self.factoid_cache.get(subject)
+        
+        if factoids is FactoidCache.MISS:
+            generation = self.factoid_cache.generation
+            factoids = await self.read("fetch_subject_factoids", subject, self.factoid_cache.max_factoids)
+            self.factoid_cache.put(subject, factoids, generation)
+        
+        return factoids
+    
+    def invalidate_subject(self, subject):
+        if self.factoid_cache is not None:
+            self.factoid_cache.invalidate(subject)
+    
+    async def fetch_factoid(self, subject, factoid_number):
+        if self.factoid_cache is not None:
+            factoids = await self.get_subject_factoids(subject)
+            
+            if factoids is not None:
+                if factoid_number is None:
+                    if len(factoids) > 0:
+                        return random.choice(factoids)
+                elif factoid_number < len(factoids):
+                    return factoids[factoid_number]
+                
+                return Factoid.missing(subject, factoid_number)
+        
+        return await self.read("fetch_factoid", subject, factoid_number)
+    
+    def fetch_random_factoid(self):
+        return self.read("fetch_random_factoid")
+    
+    def get_factoid(self, subject, separator, factoid):
+        return self.read("get_factoid", subject, separator, factoid)
+    
+    def get_factoid_by_id(self, id):
+        return self.read("get_factoid_by_id", id)
+    
+    async def count_factoids(self, subject):
+        if self.factoid_cache is not None:
+            factoids = await self.get_subject_factoids(subject)
+            
+            if factoids is not None:
+                return len(factoids)
+        
+        return await self.read("count_factoids", subject)
+    
+    def get_factoid_number(self, factoid):
+        return self.read("get_factoid_number", factoid)
+    
+    def factoid_exists(self, subject, separator, factoid):
+        return self.read("factoid_exists", subject, separator, factoid)
+    
+    def add_factoid(self, subject, separator, factoid, who_added, subject_group):
+        self.invalidate_subject(subject)
+        return self.write("add_factoid", subject, separator, factoid, who_added, subject_group)
+    
+    def delete_factoid_by_id(self, factoid_id):
+        if self.factoid_cache is not None:
+            self.factoid_cache.invalidate_factoid(factoid_id)
+        
+        return self.write("delete_factoid_by_id", factoid_id)
+    
+    def get_subject_group(self, subject):
+        return self.read("get_subject_group", subject)
+    
+    def add_subject(self, subject):
+        self.invalidate_subject(subject)
+        return self.write("add_subject", subject)
+    
+    def get_or_add_subject_group(self, subject):
+        self.invalidate_subject(subject)
+        return self.write("get_or_add_subject_group", subject)
+    
+    def initialize_group_id(self, subject):
+        self.invalidate_subject(subject)
+        return self.write("initialize_group_id", subject)
+    
+    def add_deny(self, subject):
+        return self.write("add_deny", subject)
+    
+    def remove_deny(self, subject):
+        return self.write("remove_deny", subject)
+    
+    def is_subject_denied(self, subject):
+        return self.read("is_subject_denied", subject)
+    
+    def get_user_by_name(self, username):
+        return self.read("get_user_by_name", username)
+    
+    def get_user_salt(self, username):
+        return self.read("get_user_salt", username)
+    
+    def identify(self, username, user_key):
+        return self.read("identify", username, user_key)
+    
+    def set_user_host(self, user_id, hostmask, network):
+        return self.write("set_user_host", user_id, hostmask, network)
+    
+    def add_user(self, username, user_key, salt, flags):
+        return self.write("add_user", username, user_key, salt, flags)
+    
+    def remove_user(self, username):
+        return self.write("remove_user", username)
+    
+    def change_password(self, username, old_key, new_key):
+        return self.write("change_password", username, old_key, new_key)
+    
+    def get_identified_users(self):
+        return self.read("get_identified_users")
+    
+    def add_user_mask(self, user_id, mask, network):
+        return self.write("add_user_mask", user_id, mask, network)
+    
+    def remove_user_mask(self, user_id, mask, network):
+        return self.write("remove_user_mask", user_id, mask, network)
+    
+    def get_user_masks(self):
+        return self.read("get_user_masks")
+    
+    def set_user_channel_flags(self, user_id, channel, flags, network):
+        return self.write("set_user_channel_flags", user_id, channel, flags, network)
+    
+    def get_user_channel_flags(self):
+        return self.read("get_user_channel_flags")
+    
+    def add_ignore(self, nick, host, endtime, whoignored):
+        return self.write("add_ignore", nick, host, endtime, whoignored)
+    
+    def remove_ignore(self, nick, host):
+        return self.write("remove_ignore", nick, host)
+    
+    def is_user_ignored(self, host):
+        return self.read("is_user_ignored", host)
+    
+    def get_active_ignores(self):
+        return self.read("get_active_ignores")
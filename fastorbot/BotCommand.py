@@ -1,38 +1,63 @@
-import re
+import inspect
 import shlex
 
+from fastorbot.BotUser import *
+
 class BotCommand(object):
-    def __init__(self, command, function, required_flag):
+    # How the text after the command word is turned into the list of arguments the command's function gets
+    # The rest of the line as one argument, or no arguments if it's empty
+    ARGUMENTS_RAW = "raw"
+    
+    # Split on whitespace
+    ARGUMENTS_WORDS = "words"
+    
+    # Split like a shell command line, so an argument in quotes can contain spaces
+    ARGUMENTS_TOKENS = "tokens"
+    
+    # usage is sent, after "Usage: ", when the arguments can't be read
+    def __init__(self, command, function, required_flag, argument_spec=ARGUMENTS_TOKENS, usage=None):
         self.command = command
         self.function = function
         self.required_flag = required_flag
+        self.argument_spec = argument_spec
+        self.usage = usage
         
-    def execute(self, command_text, bot_user, irc_connection, irc_message):
-        if (self.required_flag is None) or (self.required_flag in bot_user.flags):
-            arguments = BotCommand.get_command_arguments(command_text)
-            self.function(irc_connection, irc_message, arguments, bot_user)
+        # A command with no required flag needs no bits, so every user passes the check
+        if required_flag is None:
+            self.required_bits = 0
         else:
-            irc_connection.send_message(irc_message.response_destination, "I don't have to listen to you")
+            self.required_bits = BotUser.get_flag_bits(required_flag)
     
-    @staticmethod
-    def get_command_text(bot_nick, irc_message, command_separators):
-        command_pattern = re.compile("^{bot_nick}\s*({command_separators})\s*".format(bot_nick=bot_nick,command_separators="|".join(command_separators)))
+    # arguments_text is the text after the command word
+    # flag_bits are the user's global flags combined with any they have for the channel the command was sent to
+    async def execute(self, arguments_text, bot_user, flag_bits, irc_connection, irc_message):
+        if (flag_bits & self.required_bits) != self.required_bits:
+            irc_connection.send_message(irc_message.response_destination, "I don't have to listen to you")
+            return
         
-        # Check if the message begins with the bot's nick or if the message was sent as a private message to the bot
-        if command_pattern.search(irc_message.rest) or (irc_message.destination == bot_nick):
-            command_text = command_pattern.sub("", irc_message.rest)
-        else:
-            command_text = None
+        try:
+            arguments = self.get_arguments(arguments_text)
+        except ValueError as e:
+            irc_connection.send_notice(irc_message.source.nick, "Couldn't read the arguments: " + str(e))
+            if self.usage is not None:
+                irc_connection.send_notice(irc_message.source.nick, "Usage: " + self.usage)
+            
+            return
         
-        return command_text
+        # Commands that query the database are coroutines; simple ones return straight away
+        result = self.function(irc_connection, irc_message, arguments, bot_user)
+        if inspect.isawaitable(result):
+            await result
     
-    @staticmethod
-    def get_command_arguments(command_text):
-        # Split the command string on spaces
-        #parts = re.split("\s+", command_text)
-        parts = shlex.split(command_text)
-        
-        # Remove the command from the beginning of the list
-        parts.pop(0)
-        
-        return parts
+    # Raises ValueError if the text can't be split, e.g. a quote that's never closed
+    def get_arguments(self, arguments_text):
+        if self.argument_spec == BotCommand.ARGUMENTS_RAW:
+            arguments_text = arguments_text.strip()
+            if arguments_text == "":
+                return []
+            else:
+                return [arguments_text]
+        elif self.argument_spec == BotCommand.ARGUMENTS_WORDS:
+            return arguments_text.split()
+        else:
+            return shlex.split(arguments_text)
@@ -11,9 +11,30 @@ class BotUser(object):
     FLAG_BOTMASTER = "m"
 
     ALLFLAGS = "abdegmnos"
-		
+    
+    # Flags that can be given to a user for one channel; ignores, adding users and other admin work affect every
+    # channel, so their flags can only be global
+    CHANNEL_FLAGS = "adegos"
+    
+    # Each flag is also a bit, so checking a command's flag is one AND
+    FLAG_BITS = dict((flag, 1 << bit) for (bit, flag) in enumerate(ALLFLAGS))
+    
     def __init__(self, id, username, flags, hostmask):
         self.id = id
         self.username = username
         self.flags = flags
+        self.flag_bits = BotUser.get_flag_bits(flags)
         self.hostmask = hostmask
+    
+    # Unknown flags are ignored
+    @staticmethod
+    def get_flag_bits(flags):
+        flag_bits = 0
+        for flag in flags:
+            flag_bits |= BotUser.FLAG_BITS.get(flag, 0)
+        
+        return flag_bits
+    
+    @staticmethod
+    def get_flag_string(flag_bits):
+        return "".join(flag for flag in BotUser.ALLFLAGS if flag_bits & BotUser.FLAG_BITS[flag])
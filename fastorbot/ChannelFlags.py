@@ -0,0 +1,26 @@
+class ChannelFlags(object):
+    # Flags users have been given for particular channels, on top of their global flags
+    # Kept as bits by (user id, channel) so a command's permission check is a dict lookup and an AND; the database is
+    # only read at startup, and each grant or revoke updates the entry after writing it
+    def __init__(self):
+        # (user id, lowercased channel) -> flag bits
+        self.flag_bits = dict()
+    
+    def get(self, user_id, channel):
+        return self.flag_bits.get((user_id, channel.lower()), 0)
+    
+    def set(self, user_id, channel, flag_bits):
+        key = (user_id, channel.lower())
+        
+        if flag_bits == 0:
+            self.flag_bits.pop(key, None)
+        else:
+            self.flag_bits[key] = flag_bits
+    
+    def remove_user(self, user_id):
+        for key in [key for key in self.flag_bits if key[0] == user_id]:
+            del self.flag_bits[key]
+    
+    # Returns a list of tuples (channel, flag bits), sorted by channel
+    def get_user_channels(self, user_id):
+        return sorted((channel, flag_bits) for ((key_user_id, channel), flag_bits) in self.flag_bits.items() if key_user_id == user_id)
@@ -0,0 +1,51 @@
+import re
+
+class CommandMatcher(object):
+    # Regexes are compiled once per nick; Fastorbot builds a new matcher when the bot's nick changes
+    def __init__(self, bot_nick, command_separators, separators):
+        self.bot_nick = bot_nick
+        
+        # A message addressed to the bot starts with its nick and a command separator, e.g. "fastorbot: "
+        self.command_pattern = re.compile("^{bot_nick}\\s*({command_separators})\\s*".format(
+            bot_nick=re.escape(bot_nick),
+            command_separators="|".join(re.escape(separator) for separator in command_separators)
+        ))
+        
+        # A factoid definition has a separator word between the subject and the factoid, e.g. "X is Y"
+        self.factoid_pattern = re.compile("\\s({separators})\\s".format(
+            separators="|".join(re.escape(separator) for separator in separators)
+        ))
+    
+    # Returns the text of a command sent to the bot, or None if the message isn't addressed to it
+    def get_command_text(self, irc_message):
+        match = self.command_pattern.match(irc_message.rest)
+        
+        # Check if the message begins with the bot's nick or if the message was sent as a private message to the bot
+        if match is not None:
+            command_text = irc_message.rest[match.end():]
+        elif irc_message.destination == self.bot_nick:
+            command_text = irc_message.rest
+        else:
+            command_text = None
+        
+        return command_text
+    
+    # Returns a tuple (command word, rest of the text)
+    def split_command(self, command_text):
+        parts = command_text.split(None, 1)
+        
+        if len(parts) == 0:
+            return ("", "")
+        elif len(parts) > 1:
+            return (parts[0], parts[1])
+        else:
+            return (parts[0], "")
+    
+    def is_factoid_definition(self, command_text):
+        return self.factoid_pattern.search(command_text) is not None
+    
+    # Returns a tuple (subject, separator, factoid) from a factoid definition
+    def split_factoid(self, command_text):
+        parts = self.factoid_pattern.split(command_text, 1)
+        
+        return (parts[0].strip(), parts[1].strip(), parts[2].strip())
@@ -0,0 +1,65 @@
+class CommandRegistry(object):
+    # Finds the BotCommand for the first word of a command: its name, one of its aliases, or, when min_abbreviation is
+    # more than 0, a prefix at least that long that only one command starts with
+    # Names and aliases are looked up in a dict; the trie of their characters is only walked for abbreviations
+    # Abbreviations are off by default, since every prefix they claim can no longer be fetched as a factoid
+    def __init__(self, min_abbreviation=0):
+        self.min_abbreviation = min_abbreviation
+        
+        # Name or alias -> BotCommand
+        self.names = dict()
+        
+        self.trie = CommandTrieNode()
+    
+    def add(self, bot_command):
+        self.add_name(bot_command.command, bot_command)
+    
+    # Raises EnvironmentError if the alias is already taken or the command doesn't exist, since aliases come from the config
+    def add_alias(self, alias, command_name):
+        if command_name not in self.names:
+            raise EnvironmentError("Alias %s is for an unknown command %s" % (alias, command_name))
+        
+        if alias in self.names:
+            raise EnvironmentError("Alias %s is already a command or alias" % (alias))
+        
+        self.add_name(alias, self.names[command_name])
+    
+    def add_name(self, name, bot_command):
+        self.names[name] = bot_command
+        
+        node = self.trie
+        node.commands.add(bot_command)
+        for character in name:
+            node = node.children.setdefault(character, CommandTrieNode())
+            node.commands.add(bot_command)
+    
+    def __contains__(self, name):
+        return self.get(name) is not None
+    
+    # Returns the BotCommand for a word, or None if it isn't a command (or is a prefix of more than one)
+    def get(self, word):
+        bot_command = self.names.get(word)
+        if (bot_command is not None) or (self.min_abbreviation == 0) or (len(word) < self.min_abbreviation):
+            return bot_command
+        
+        node = self.trie
+        for character in word:
+            node = node.children.get(character)
+            if node is None:
+                return None
+        
+        # An alias and its command share a BotCommand, so a prefix of both still names only one command
+        if len(node.commands) == 1:
+            return next(iter(node.commands))
+        
+        return None
+
+class CommandTrieNode(object):
+    __slots__ = ("children", "commands")
+    
+    def __init__(self):
+        # Character -> CommandTrieNode
+        self.children = dict()
+        
+        # Every BotCommand with a name or alias starting with the characters up to this node
+        self.commands = set()
@@ -0,0 +1,71 @@
+import asyncio
+
+# Raised by CommandScheduler.run when a command runs out of time; a TimeoutError from inside the command itself isn't
+# turned into one of these
+class CommandTimeout(Exception):
+    pass
+
+class CommandScheduler(object):
+    # Runs each command as its own task, so a slow one never holds up reading the next line from the server
+    # At most max_per_destination commands run at once for each channel (or each user, for private messages), and the
+    # rest wait their turn; once running, each has timeout seconds to finish
+    def __init__(self, timeout=30, max_per_destination=4):
+        self.timeout = timeout
+        self.max_per_destination = max_per_destination
+        
+        # Tasks that haven't finished yet
+        self.tasks = set()
+        
+        # Destination -> [semaphore, number of commands running or waiting]; entries are removed once that's 0
+        self.semaphores = dict()
+    
+    def start(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        
+        return task
+    
+    # Waits for a turn in the destination, then calls coroutine_function and waits for the coroutine it returns;
+    # raises CommandTimeout if that takes more than timeout seconds
+    async def run(self, destination, coroutine_function):
+        entry = self.semaphores.get(destination)
+        if entry is None:
+            entry = [asyncio.Semaphore(self.max_per_destination), 0]
+            self.semaphores[destination] = entry
+        
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self.run_with_timeout(coroutine_function)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.semaphores[destination]
+    
+    # wait_for raises the same TimeoutError whether it ran out of time or the command raised one, e.g. from its own
+    # wait_for, so note which it was
+    async def run_with_timeout(self, coroutine_function):
+        raised_by_command = False
+        
+        async def run_command():
+            nonlocal raised_by_command
+            
+            try:
+                await coroutine_function()
+            except asyncio.TimeoutError:
+                raised_by_command = True
+                raise
+        
+        try:
+            await asyncio.wait_for(run_command(), self.timeout)
+        except asyncio.TimeoutError:
+            if raised_by_command:
+                raise
+            
+            raise CommandTimeout("Command took more than %g seconds" % self.timeout) from None
+    
+    # Cancels every task still waiting or running, e.g. when the connection they would reply on has gone
+    def cancel_all(self):
+        for task in list(self.tasks):
+            task.cancel()
@@ -0,0 +1,121 @@
+import math
+import random
+import re
+
+class DiceRoller(object):
+    # One term of a roll: an optional sign, then dice such as 3d6 or 4d6k3, or a plain number
+    TERM_PATTERN = re.compile(r"\s*([+-]?)\s*(?:(\d*)d(\d+)(?:(kh|kl|k)(\d+))?|(\d+))\s*", re.IGNORECASE)
+    
+    # Longest roll string accepted, which also keeps every number in it small enough to parse quickly
+    MAX_LENGTH = 100
+    
+    # Evaluates rolls such as "2d6+3", "d20" or "4d6k3 + 1d4 - 1"
+    # Totals of up to exact_limit dice in a term are rolled die by die; larger terms are drawn from the normal approximation
+    # of the sum, so any roll within max_dice and max_sides takes the same short time
+    def __init__(self, max_dice=1000000000, max_sides=1000000, max_terms=10, exact_limit=10000):
+        self.max_dice = max_dice
+        self.max_sides = max_sides
+        self.max_terms = max_terms
+        self.exact_limit = exact_limit
+    
+    # Returns the total of a roll, or raises ValueError with a message for the user
+    def roll(self, roll_string):
+        total = 0
+        
+        for (sign, count, sides, keep_mode, keep_count, constant) in self.parse(roll_string):
+            if constant is not None:
+                value = constant
+            elif keep_mode is not None:
+                value = self.roll_keep(count, sides, keep_mode, keep_count)
+            else:
+                value = self.roll_sum(count, sides)
+            
+            total += sign * value
+        
+        return total
+    
+    # Returns a list of tuples (sign, count, sides, keep mode, keep count, constant); constant is None for dice
+    def parse(self, roll_string):
+        roll_string = roll_string.strip()
+        if roll_string == "":
+            raise ValueError("Nothing to roll")
+        
+        if len(roll_string) > DiceRoller.MAX_LENGTH:
+            raise ValueError("Roll is longer than %d characters" % (DiceRoller.MAX_LENGTH))
+        
+        terms = list()
+        total_dice = 0
+        position = 0
+        
+        while position < len(roll_string):
+            term_match = DiceRoller.TERM_PATTERN.match(roll_string, position)
+            
+            # Every term after the first needs a sign to separate it from the one before
+            if (term_match is None) or ((position > 0) and (term_match.group(1) == "")):
+                raise ValueError("Incorrect roll format at \"%s\"" % (roll_string[position:]))
+            
+            position = term_match.end()
+            
+            if term_match.group(1) == "-":
+                sign = -1
+            else:
+                sign = 1
+            
+            if term_match.group(6) is not None:
+                terms.append((sign, None, None, None, None, int(term_match.group(6))))
+            else:
+                count = int(term_match.group(2) or 1)
+                sides = int(term_match.group(3))
+                
+                if (count < 1) or (sides < 1):
+                    raise ValueError("Dice need at least one die and one side")
+                
+                if sides > self.max_sides:
+                    raise ValueError("Dice can have at most %d sides" % (self.max_sides))
+                
+                total_dice += count
+                if total_dice > self.max_dice:
+                    raise ValueError("At most %d dice can be rolled at once" % (self.max_dice))
+                
+                if term_match.group(4) is not None:
+                    keep_mode = term_match.group(4).lower()
+                    keep_count = int(term_match.group(5))
+                    
+                    # Keeping some dice means rolling each of them
+                    if count > self.exact_limit:
+                        raise ValueError("At most %d dice can be rolled when keeping the highest or lowest" % (self.exact_limit))
+                    
+                    if (keep_count < 1) or (keep_count > count):
+                        raise ValueError("Can only keep between 1 and %d dice" % (count))
+                else:
+                    keep_mode = None
+                    keep_count = None
+                
+                terms.append((sign, count, sides, keep_mode, keep_count, None))
+            
+            if len(terms) > self.max_terms:
+                raise ValueError("A roll can have at most %d terms" % (self.max_terms))
+        
+        return terms
+    
+    def roll_sum(self, count, sides):
+        if sides == 1:
+            return count
+        
+        if count <= self.exact_limit:
+            return sum(random.choices(range(1, sides + 1), k=count))
+        
+        # The sum of many dice is close to normally distributed; the result is rounded and kept within the possible totals
+        mean = count * (sides + 1) / 2
+        deviation = math.sqrt(count * ((sides * sides) - 1) / 12)
+        total = round(random.gauss(mean, deviation))
+        
+        return min(max(total, count), count * sides)
+    
+    def roll_keep(self, count, sides, keep_mode, keep_count):
+        dice = sorted(random.choices(range(1, sides + 1), k=count))
+        
+        if keep_mode == "kl":
+            return sum(dice[:keep_count])
+        else:
+            return sum(dice[-keep_count:])
@@ -21,6 +21,14 @@ class Factoid(object):
             message_text = self.subject + " " + self.separator + " " + self.fact
             connection.send_message(destination, message_text)
     
+    # Placeholder sent when a subject has no factoids, or none with the requested number
+    @staticmethod
+    def missing(subject, factoid_number):
+        if factoid_number is not None:
+            return Factoid(None, None, None, "There is no factoid number {factoid_number:d} for {subject}".format(factoid_number=factoid_number,subject=subject), None, None, 0)
+        else:
+            return Factoid(None, None, None, "There are no factoids for " + subject, None, None, 0)
+    
     @staticmethod
     def parse_subject_and_number(text):
         factoid_number_regex = re.compile(":(\d+)$")
@@ -0,0 +1,77 @@
+import collections
+
+from fastorbot.SQLiteDatabase import *
+
+class FactoidCache(object):
+    # Returned by get() when the subject isn't cached
+    MISS = object()
+    
+    def __init__(self, max_subjects=1024, max_factoids=500):
+        self.max_subjects = max_subjects
+        
+        # Subjects with more factoids than this aren't cached and are always looked up in the database
+        self.max_factoids = max_factoids
+        
+        # Subject key -> list of the subject's factoids in factoid number order, least recently used first
+        # Subjects with too many factoids are stored as None so they go straight to the database
+        self.entries = collections.OrderedDict()
+        
+        # Factoid id -> subject key of the cached entry holding it, so deletes can find the entry to drop
+        self.factoid_subjects = dict()
+        
+        # Bumped on every invalidation; a lookup that started before an invalidation mustn't store its result
+        self.generation = 0
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, subject):
+        subject_key = SQLiteDatabase.subject_key(subject)
+        
+        if subject_key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(subject_key)
+            return self.entries[subject_key]
+        
+        self.misses += 1
+        return FactoidCache.MISS
+    
+    def put(self, subject, factoids, generation):
+        if generation != self.generation:
+            return
+        
+        subject_key = SQLiteDatabase.subject_key(subject)
+        
+        self.remove_entry(subject_key)
+        self.entries[subject_key] = factoids
+        self.remember_factoids(factoids, subject_key)
+        
+        while len(self.entries) > self.max_subjects:
+            (evicted_key, evicted_factoids) = self.entries.popitem(last=False)
+            self.forget_factoids(evicted_factoids)
+            self.evictions += 1
+    
+    def invalidate(self, subject):
+        self.generation += 1
+        self.remove_entry(SQLiteDatabase.subject_key(subject))
+    
+    def invalidate_factoid(self, factoid_id):
+        self.generation += 1
+        
+        if factoid_id in self.factoid_subjects:
+            self.remove_entry(self.factoid_subjects[factoid_id])
+    
+    def remove_entry(self, subject_key):
+        if subject_key in self.entries:
+            self.forget_factoids(self.entries.pop(subject_key))
+    
+    def remember_factoids(self, factoids, subject_key):
+        if factoids is not None:
+            for factoid in factoids:
+                self.factoid_subjects[factoid.id] = subject_key
+    
+    def forget_factoids(self, factoids):
+        if factoids is not None:
+            for factoid in factoids:
+                self.factoid_subjects.pop(factoid.id, None)
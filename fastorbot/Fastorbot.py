@@ -1,53 +1,103 @@
 import asyncio
 import datetime
+import functools
 import logging
 import math
 import random
-import re
 import signal
 import sqlite3
 import sys
 import time
 import xml.etree.ElementTree as etree
 
+from fastorbot.AsyncDatabase import *
 from fastorbot.BotCommand import *
 from fastorbot.BotUser import *
+from fastorbot.CommandMatcher import *
+from fastorbot.CommandRegistry import *
+from fastorbot.CommandScheduler import *
+from fastorbot.DiceRoller import *
+from fastorbot.FactoidCache import *
+from fastorbot.IgnoreList import *
 from fastorbot.IRCConnection import *
+from fastorbot.IRCSendQueue import *
+from fastorbot.LameNick import *
+from fastorbot.LogPipeline import *
+from fastorbot.LoopWatchdog import *
+from fastorbot.MetricsRegistry import *
+from fastorbot.MetricsServer import *
+from fastorbot.NetworkState import *
+from fastorbot.PasswordHasher import *
 from fastorbot.SQLiteDatabase import *
 
 class Fastorbot(object):
+    # Most lines the stats command sends at once
+    MAX_STATS_LINES = 15
     
     def __init__(self):
         tree = etree.parse("config.xml")
         self.config_tree = tree.getroot()
         
-        # Bot commands
-        self.commands = dict()
-        self.add_command(BotCommand("that", self.command_that, BotUser.FLAG_GETFACTS))
-        self.add_command(BotCommand("whoadded", self.command_whoadded, BotUser.FLAG_GETFACTS))
-        self.add_command(BotCommand("forget", self.command_forget, BotUser.FLAG_DELFACTS))
-        self.add_command(BotCommand("count", self.command_count, BotUser.FLAG_GETFACTS))
-        self.add_command(BotCommand("random", self.command_random, BotUser.FLAG_GETFACTS))
-        self.add_command(BotCommand("deny", self.command_deny, BotUser.FLAG_BOTADMIN))
-        self.add_command(BotCommand("undeny", self.command_undeny, BotUser.FLAG_BOTADMIN))
-        
-        self.add_command(BotCommand("adduser", self.command_add_user, BotUser.FLAG_BOTADMIN))
-        self.add_command(BotCommand("deluser", self.command_remove_user, BotUser.FLAG_BOTADMIN))
-        self.add_command(BotCommand("identify", self.command_identify, BotUser.FLAG_NONE))
-        self.add_command(BotCommand("password", self.command_password, BotUser.FLAG_NONE))
-        
-        self.add_command(BotCommand("ignore", self.command_ignore, BotUser.FLAG_BOTOP))
-        self.add_command(BotCommand("unignore", self.command_unignore, BotUser.FLAG_BOTOP))
-        
-        self.add_command(BotCommand("time", self.command_time, BotUser.FLAG_GETFACTS))
-        self.add_command(BotCommand("lamenick", self.command_lamenick, BotUser.FLAG_GETFACTS))
-        self.add_command(BotCommand("roll", self.command_roll_dice, BotUser.FLAG_GETFACTS))
-        
-        self.add_command(BotCommand("startpoll", self.command_startpoll, BotUser.FLAG_GETFACTS))
-        self.add_command(BotCommand("poll", self.command_poll_choose, BotUser.FLAG_GETFACTS))
-        self.add_command(BotCommand("endpoll", self.command_endpoll, BotUser.FLAG_GETFACTS))
-        
-        self.add_command(BotCommand("quit", self.command_quit, BotUser.FLAG_BOTADMIN))
+        # Log records are written by a background thread, to a file that's rotated once it reaches max_bytes
+        logging_node = self.config_tree.find("global/logging")
+        if logging_node is not None:
+            self.log_pipeline = LogPipeline(logging_node.get("file", "fastorbot.log"), LogPipeline.get_level(logging_node.get("level", "debug")), int(logging_node.get("max_bytes", 10485760)), int(logging_node.get("backup_count", 5)))
+        else:
+            self.log_pipeline = LogPipeline()
+        
+        self.log_pipeline.start()
+        self.logger = logging.getLogger('fastorbot')
+        
+        # Bot commands; only those whose arguments can be quoted to contain spaces are split like a shell command line
+        # Each command gets timeout seconds to run, and up to max_per_channel run at once in a channel
+        commands_node = self.config_tree.find("global/commands")
+        if commands_node is not None:
+            self.commands = CommandRegistry(int(commands_node.get("min_abbreviation", 0)))
+            self.command_timeout = float(commands_node.get("timeout", 30))
+            self.max_commands_per_channel = int(commands_node.get("max_per_channel", 4))
+        else:
+            self.commands = CommandRegistry()
+            self.command_timeout = 30
+            self.max_commands_per_channel = 4
+        
+        self.add_command(BotCommand("that", self.command_that, BotUser.FLAG_GETFACTS, BotCommand.ARGUMENTS_WORDS))
+        self.add_command(BotCommand("whoadded", self.command_whoadded, BotUser.FLAG_GETFACTS, BotCommand.ARGUMENTS_TOKENS, "whoadded [subject]:[number]"))
+        self.add_command(BotCommand("forget", self.command_forget, BotUser.FLAG_DELFACTS, BotCommand.ARGUMENTS_TOKENS, "forget [subject:num | that]"))
+        self.add_command(BotCommand("count", self.command_count, BotUser.FLAG_GETFACTS, BotCommand.ARGUMENTS_TOKENS, "count [subject]"))
+        self.add_command(BotCommand("random", self.command_random, BotUser.FLAG_GETFACTS, BotCommand.ARGUMENTS_WORDS))
+        self.add_command(BotCommand("deny", self.command_deny, BotUser.FLAG_BOTADMIN, BotCommand.ARGUMENTS_TOKENS, "deny [subject]"))
+        self.add_command(BotCommand("undeny", self.command_undeny, BotUser.FLAG_BOTADMIN, BotCommand.ARGUMENTS_TOKENS, "undeny [subject]"))
+        
+        self.add_command(BotCommand("adduser", self.command_add_user, BotUser.FLAG_BOTADMIN, BotCommand.ARGUMENTS_WORDS))
+        self.add_command(BotCommand("deluser", self.command_remove_user, BotUser.FLAG_BOTADMIN, BotCommand.ARGUMENTS_WORDS))
+        self.add_command(BotCommand("identify", self.command_identify, BotUser.FLAG_NONE, BotCommand.ARGUMENTS_TOKENS, "identify [username] password"))
+        self.add_command(BotCommand("password", self.command_password, BotUser.FLAG_NONE, BotCommand.ARGUMENTS_TOKENS, "password [username] oldpass newpass"))
+        self.add_command(BotCommand("addmask", self.command_add_mask, BotUser.FLAG_NONE, BotCommand.ARGUMENTS_WORDS))
+        self.add_command(BotCommand("delmask", self.command_remove_mask, BotUser.FLAG_NONE, BotCommand.ARGUMENTS_WORDS))
+        self.add_command(BotCommand("masks", self.command_masks, BotUser.FLAG_NONE, BotCommand.ARGUMENTS_WORDS))
+        self.add_command(BotCommand("grant", self.command_grant, BotUser.FLAG_BOTADMIN, BotCommand.ARGUMENTS_WORDS))
+        self.add_command(BotCommand("revoke", self.command_revoke, BotUser.FLAG_BOTADMIN, BotCommand.ARGUMENTS_WORDS))
+        
+        self.add_command(BotCommand("ignore", self.command_ignore, BotUser.FLAG_BOTOP, BotCommand.ARGUMENTS_WORDS))
+        self.add_command(BotCommand("unignore", self.command_unignore, BotUser.FLAG_BOTOP, BotCommand.ARGUMENTS_WORDS))
+        
+        self.add_command(BotCommand("time", self.command_time, BotUser.FLAG_GETFACTS, BotCommand.ARGUMENTS_WORDS))
+        self.add_command(BotCommand("lamenick", self.command_lamenick, BotUser.FLAG_GETFACTS, BotCommand.ARGUMENTS_WORDS))
+        self.add_command(BotCommand("roll", self.command_roll_dice, BotUser.FLAG_GETFACTS, BotCommand.ARGUMENTS_RAW))
+        
+        self.add_command(BotCommand("startpoll", self.command_startpoll, BotUser.FLAG_GETFACTS, BotCommand.ARGUMENTS_TOKENS, "startpoll question [choice ...]"))
+        self.add_command(BotCommand("poll", self.command_poll_choose, BotUser.FLAG_GETFACTS, BotCommand.ARGUMENTS_WORDS))
+        self.add_command(BotCommand("endpoll", self.command_endpoll, BotUser.FLAG_GETFACTS, BotCommand.ARGUMENTS_WORDS))
+        
+        self.add_command(BotCommand("cachestats", self.command_cachestats, BotUser.FLAG_BOTADMIN, BotCommand.ARGUMENTS_WORDS))
+        self.add_command(BotCommand("lag", self.command_lag, BotUser.FLAG_GETFACTS, BotCommand.ARGUMENTS_WORDS))
+        self.add_command(BotCommand("stats", self.command_stats, BotUser.FLAG_BOTMASTER, BotCommand.ARGUMENTS_WORDS))
+        self.add_command(BotCommand("quit", self.command_quit, BotUser.FLAG_BOTADMIN, BotCommand.ARGUMENTS_WORDS))
+        
+        # Other names for commands, e.g. <alias name="w" command="whoadded" />
+        if commands_node is not None:
+            for alias_node in commands_node.findall("alias"):
+                self.commands.add_alias(alias_node.get("name"), alias_node.get("command"))
         
         self.separators = list()
         separator_nodes = self.config_tree.findall("global/separators/separator")
@@ -59,16 +109,87 @@ class Fastorbot(object):
         for n in separator_nodes:
             self.command_separators.append(n.text)
         
-        self.that_factoids = dict()
-        self.identified_users = dict()
+        # Limits on what one roll command can ask for
+        dice_node = self.config_tree.find("global/dice")
+        if dice_node is not None:
+            self.dice_roller = DiceRoller(int(dice_node.get("max_dice", 1000000000)), int(dice_node.get("max_sides", 1000000)), int(dice_node.get("max_terms", 10)), int(dice_node.get("exact_limit", 10000)))
+        else:
+            self.dice_roller = DiceRoller()
+        
+        self.lame_nick = LameNick()
+        
         self.default_bot_user = BotUser(0, "", BotUser.FLAG_GETFACTS + BotUser.FLAG_ADDFACTS + BotUser.FLAG_DELOWNFACTS, "")
-        self.current_poll = None
+        
+        # IRCConnection -> NetworkState for each configured server
+        self.networks = dict()
+        self.loop = None
+        
+        # Counters and timings for commands, database queries and IRC traffic
+        self.metrics = MetricsRegistry()
+        
+        metrics_node = self.config_tree.find("global/metrics")
+        if metrics_node is not None:
+            self.metrics_dump_file = metrics_node.get("dump_file")
+            self.metrics_dump_interval = float(metrics_node.get("dump_interval", 60))
+        else:
+            self.metrics_dump_file = None
+            self.metrics_dump_interval = None
+        
+        # Metrics can also be scraped over HTTP, from localhost unless listen_host says otherwise
+        if (metrics_node is not None) and (metrics_node.get("listen_port") is not None):
+            self.metrics_server = MetricsServer(self, metrics_node.get("listen_host", "127.0.0.1"), int(metrics_node.get("listen_port")))
+        else:
+            self.metrics_server = None
+        
+        # The watchdog reports callbacks and commands that hold up the event loop for more than threshold seconds;
+        # debug turns on asyncio's debug mode, which also logs each callback that takes more than slow_callback seconds
+        watchdog_node = self.config_tree.find("global/watchdog")
+        if watchdog_node is not None:
+            self.watchdog = LoopWatchdog(self.metrics, float(watchdog_node.get("interval", 0.5)), float(watchdog_node.get("threshold", 0.5)))
+            self.loop_debug = (watchdog_node.get("debug", "false") == "true")
+            self.slow_callback_duration = float(watchdog_node.get("slow_callback", 0.1))
+        else:
+            self.watchdog = LoopWatchdog(self.metrics)
+            self.loop_debug = False
+            self.slow_callback_duration = 0.1
         
         self.database_connect()
         
-        identified_users = self.db.get_identified_users()
-        for bot_user in identified_users:
-            self.identified_users[bot_user.hostmask] = bot_user
+        # Password key derivation runs on a small thread pool, with a cap on how many requests may wait for it
+        hasher_node = self.config_tree.find("global/password_hashing")
+        if hasher_node is not None:
+            self.password_hasher = PasswordHasher(int(hasher_node.get("workers", 2)), int(hasher_node.get("max_pending", 4)), self.metrics)
+        else:
+            self.password_hasher = PasswordHasher(metrics=self.metrics)
+        
+        self.create_networks()
+        
+        # Users are restored to the network they identified on; hosts saved before networks were recorded
+        # belong to the first server, which was the only one the bot used to connect to
+        networks_by_name = dict((network.name, network) for network in self.networks.values())
+        first_network = self.get_network_list()[0]
+        
+        identified_users = self.db.call_sync("get_identified_users")
+        for (network_name, bot_user) in identified_users:
+            if network_name == "":
+                first_network.identified_users.add_host(bot_user.hostmask, bot_user)
+            elif network_name in networks_by_name:
+                networks_by_name[network_name].identified_users.add_host(bot_user.hostmask, bot_user)
+        
+        for (network_name, mask, bot_user) in self.db.call_sync("get_user_masks"):
+            if network_name in networks_by_name:
+                networks_by_name[network_name].identified_users.add_mask(mask, bot_user)
+        
+        for (network_name, user_id, channel, flags) in self.db.call_sync("get_user_channel_flags"):
+            if network_name == "":
+                first_network.channel_flags.set(user_id, channel, BotUser.get_flag_bits(flags))
+            elif network_name in networks_by_name:
+                networks_by_name[network_name].channel_flags.set(user_id, channel, BotUser.get_flag_bits(flags))
+        
+        # Active ignores are kept in memory so checking a message's host doesn't need a query
+        self.ignore_list = IgnoreList()
+        for (host, endtime) in self.db.call_sync("get_active_ignores"):
+            self.ignore_list.add(host, endtime)
         
         # Gracefully handle Ctrl-C
         signal.signal(signal.SIGINT, self.signal_handler)
@@ -77,117 +198,251 @@ class Fastorbot(object):
         # Database handle
         database_node = self.config_tree.find("global/database")
         
+        # Optional write-behind batching: commit every flush_ms milliseconds or every flush_operations changes
+        write_behind_node = database_node.find("write_behind")
+        if write_behind_node is not None:
+            write_batch_size = int(write_behind_node.get("flush_operations", 50))
+            flush_interval = int(write_behind_node.get("flush_ms", 250)) / 1000
+        else:
+            write_batch_size = None
+            flush_interval = None
+        
+        # Most recently used subjects' factoids are kept in memory; setting subjects to 0 turns the cache off
+        cache_node = self.config_tree.find("global/factoid_cache")
+        if cache_node is not None:
+            cache_subjects = int(cache_node.get("subjects", 1024))
+            cache_factoids = int(cache_node.get("factoids_per_subject", 500))
+        else:
+            cache_subjects = 1024
+            cache_factoids = 500
+        
+        if cache_subjects > 0:
+            self.factoid_cache = FactoidCache(cache_subjects, cache_factoids)
+        else:
+            self.factoid_cache = None
+        
+        # Optional connection profile: PRAGMA settings such as journal_mode and synchronous
+        profile_node = database_node.find("profile")
+        if profile_node is not None:
+            profile = dict(profile_node.attrib)
+        else:
+            profile = None
+        
         if database_node.get("type") == "sqlite":
-            self.db = SQLiteDatabase(database_node.get("database"))
+            dsn = database_node.get("database")
+            
+            # An in-memory database can't be opened a second time, so its queries share the writer's connection
+            if dsn != ":memory:":
+                reader_factory = functools.partial(SQLiteDatabase, dsn, None, profile, True)
+            else:
+                reader_factory = None
+            
+            self.db = AsyncDatabase(functools.partial(SQLiteDatabase, dsn, write_batch_size, profile), reader_factory, flush_interval, self.factoid_cache, self.metrics)
         else:
             raise EnvironmentError("Invalid database type")
     
+    # Create a connection for each server in the configuration; they're connected by irc_connect()
+    def create_networks(self):
+        server_nodes = self.config_tree.findall("servers/server")
+        if len(server_nodes) == 0:
+            raise EnvironmentError("No servers are configured")
+        
+        for (server_number, server_node) in enumerate(server_nodes):
+            # The network's name identifies it in the database, so each server needs a different one
+            name = server_node.get("name", "server%d" % (server_number + 1))
+            
+            hosts = list()
+            for host_node in server_node.findall("hosts/host"):
+                hosts.append((host_node.get("name"), host_node.get("port")))
+            
+            if len(hosts) == 0:
+                raise EnvironmentError("No hosts are configured for server " + name)
+            
+            # Flood control settings should match the server's penalty rules; the defaults are ircu's
+            flood_node = server_node.find("flood_control")
+            if flood_node is not None:
+                send_queue = IRCSendQueue(float(flood_node.get("window", 10)), float(flood_node.get("line_penalty", 2)), int(flood_node.get("penalty_bytes", 120)), self.metrics)
+            else:
+                send_queue = IRCSendQueue(metrics=self.metrics)
+            
+            # The bot pings the server after keepalive interval seconds of silence and reconnects if there's no reply within timeout seconds
+            keepalive_node = server_node.find("keepalive")
+            if keepalive_node is not None:
+                keepalive_interval = float(keepalive_node.get("interval", 60))
+                keepalive_timeout = float(keepalive_node.get("timeout", 30))
+            else:
+                keepalive_interval = 60
+                keepalive_timeout = 30
+            
+            irc_connection = IRCConnection(hosts, server_node.get("nick"), send_queue, keepalive_interval, keepalive_timeout)
+            irc_connection.set_owner(self)
+            irc_connection.add_callback("JOIN", IRCCallback(self.onjoin_factoid, {"bot": self}))
+            
+            command_scheduler = CommandScheduler(self.command_timeout, self.max_commands_per_channel)
+            self.networks[irc_connection] = NetworkState(name, server_node, irc_connection, command_scheduler)
+            self.build_command_matcher(irc_connection)
+    
+    # Networks in the order they're configured
+    def get_network_list(self):
+        return list(self.networks.values())
+    
     def irc_connect(self):
-        # Connect to the servers listed in the configuration
-        server_node = self.config_tree.findall("servers")[0].findall("server")[0]
-        host_node = server_node.findall("hosts/host")[0]
-        self.irc_connection = IRCConnection(host_node.get("name"), host_node.get("port"), server_node.get("nick"))
-        self.irc_connection.set_owner(self)
+        # All the connections share one event loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        
+        if self.loop_debug:
+            self.loop.set_debug(True)
+            self.loop.slow_callback_duration = self.slow_callback_duration
+        
+        for network in self.get_network_list():
+            network.irc_connection.connect()
+        
+        if self.metrics_dump_file is not None:
+            self.loop.call_later(self.metrics_dump_interval, self.dump_metrics)
+        
+        # The metrics server runs on the same loop; the bot carries on without it if it can't listen
+        if self.metrics_server is not None:
+            try:
+                self.loop.run_until_complete(self.metrics_server.start())
+            except OSError:
+                self.logger.exception("Could not start the metrics server on %s:%d", self.metrics_server.host, self.metrics_server.port)
+        
+        self.watchdog.start(self.loop)
+        
+        self.loop.run_forever()
         
-        self.irc_connection.add_callback("JOIN", IRCCallback(self.onjoin_factoid, {"bot": self}))
+        self.watchdog.stop()
         
-        self.irc_connection.connect()
+        # quit() stops the loop once the connections have had time to send their QUIT messages
+        if self.metrics_server is not None:
+            self.metrics_server.close()
         
-        # connect() won't return normally, so it must be the last thing called in the constructor
+        self.db.close()
+        self.password_hasher.close()
+        self.log_pipeline.stop()
+    
+    # The matcher's regexes depend on the bot's nick, so it's rebuilt whenever the nick changes
+    def build_command_matcher(self, irc_connection):
+        self.networks[irc_connection].command_matcher = CommandMatcher(irc_connection.nick, self.command_separators, self.separators)
+    
+    def on_nick_change(self, irc_connection):
+        self.build_command_matcher(irc_connection)
+    
+    # Replies from commands still running would be lost, or sent on the next connection long after they were asked for
+    def on_disconnect(self, irc_connection):
+        self.networks[irc_connection].command_scheduler.cancel_all()
     
     def handle_message(self, irc_connection, irc_message):
-        asynciologger = logging.getLogger('fastorbot')
-        asynciologger.info("handle_message " + str(irc_message))
+        # Every line is logged at debug level, so the message is only formatted when that level is enabled
+        self.logger.debug("handle_message %s", irc_message)
         
-        # Ignore messages from the bot itself
-        if irc_message.source.nick == irc_connection.nick:
-            return
-        
-        if irc_message.command == "376": #end of MOTD
+        if irc_message.command in ("376", "422"): #end of MOTD, or no MOTD
             self.on_end_motd(irc_connection, irc_message)
         
         if irc_message.command == "PRIVMSG":
-            command_text = BotCommand.get_command_text(irc_connection.nick, irc_message, self.command_separators)
+            # Ignore messages from the bot itself
+            if irc_message.source.nick == irc_connection.nick:
+                return
+            
+            command_text = self.networks[irc_connection].command_matcher.get_command_text(irc_message)
             if command_text is not None:
                 # Determine if the host is being ignored
-                if self.db.is_user_ignored(irc_message.source.host):
+                if self.ignore_list.is_ignored(irc_message.source.host):
                     return
                 
-                # Determine the bot user sending the command
-                if irc_message.source.hostmask in self.identified_users:
-                    bot_user = self.identified_users[irc_message.source.hostmask]
-                else:
-                    bot_user = self.default_bot_user
-                
-                command_parts = self.get_command(command_text)
-                
-                # If the message isn't a registered command, check for adding or fetching a factoid
-                if command_parts is None:
-                    # Check for separators
-                    separators_regex = re.compile("\s({separators})\s".format(separators="|".join(self.separators)))
-                    if (separators_regex.search(command_text)):
-                        # Add new factoid
-                        self.add_factoid(irc_connection, irc_message, command_text)
-                        pass
-                    else:
-                        self.send_factoid(irc_connection, irc_message.response_destination, command_text)
+                # Commands wait on the database, so run them as tasks rather than holding up the next message
+                self.networks[irc_connection].command_scheduler.start(self.handle_command(irc_connection, irc_message, command_text))
+    
+    async def handle_command(self, irc_connection, irc_message, command_text):
+        started = time.perf_counter()
+        metric_name = "command.unknown"
+        network = self.networks[irc_connection]
+        
+        try:
+            # Determine the bot user sending the command
+            bot_user = network.identified_users.get(irc_message.source.hostmask, self.default_bot_user)
+            
+            # Flags given for the channel the command was sent to add to the user's global ones
+            flag_bits = bot_user.flag_bits | network.channel_flags.get(bot_user.id, irc_message.response_destination)
+            
+            command_parts = self.get_command(network.command_matcher, command_text)
+            
+            # If the message isn't a registered command, check for adding or fetching a factoid
+            if command_parts is None:
+                # Check for separators
+                if network.command_matcher.is_factoid_definition(command_text):
+                    # Add new factoid
+                    metric_name = "command.factoid_add"
+                    command_call = functools.partial(self.add_factoid, irc_connection, irc_message, command_text)
                 else:
-                    command = command_parts[0]
-                    #command.execute(irc_connection, irc_message, command_parts, bot_user)
-                    command.execute(command_text, bot_user, irc_connection, irc_message)
+                    metric_name = "command.factoid_get"
+                    command_call = functools.partial(self.send_factoid, irc_connection, irc_message.response_destination, command_text)
+            else:
+                command = command_parts[0]
+                metric_name = "command." + command.command
+                command_call = functools.partial(command.execute, command_parts[1], bot_user, flag_bits, irc_connection, irc_message)
+            
+            asyncio.current_task().set_name(metric_name)
+            
+            # The command is only started once there's room for it in the channel, and then has a limited time to finish
+            await network.command_scheduler.run(irc_message.response_destination, command_call)
+        except CommandTimeout:
+            self.metrics.increment(metric_name + ".timeouts")
+            self.logger.warning("Command timed out after %g seconds: %s", network.command_scheduler.timeout, command_text)
+            irc_connection.send_notice(irc_message.source.nick, "That took too long, so I gave up on it")
+        except Exception:
+            self.metrics.increment(metric_name + ".errors")
+            self.logger.exception("Error handling command: %s", command_text)
+        
+        # Time from the command arriving to it finishing, including waiting on the database and password hashing
+        self.metrics.observe(metric_name, time.perf_counter() - started)
     
     def add_command(self, bot_command):
-        self.commands[bot_command.command] = bot_command
+        self.commands.add(bot_command)
     
-    # Returns a tuple (command, rest) if the first word in the text is a registered command
-    def get_command(self, command_text):
-        parts = re.split("\s+", command_text, 1)
-        command = parts[0]
+    # Returns a tuple (command, rest) if the first word in the text is a registered command, an alias or an abbreviation of one
+    def get_command(self, command_matcher, command_text):
+        (command, rest) = command_matcher.split_command(command_text)
         
-        if len(parts) > 1:
-            rest = parts[1]
-        else:
-            rest = ""
-        
-        if command in self.commands:
-            return (self.commands[command], rest)
+        bot_command = self.commands.get(command)
+        if bot_command is not None:
+            return (bot_command, rest)
         else:
             return None
     
-    def send_factoid(self, irc_connection, destination, subject):
+    async def send_factoid(self, irc_connection, destination, subject):
         (subject, factoid_number) = Factoid.parse_subject_and_number(subject)
         
-        factoid = self.db.fetch_factoid(subject, factoid_number)
+        factoid = await self.db.fetch_factoid(subject, factoid_number)
         factoid.send(irc_connection, destination)
         
         # Store factoid in That array
         if factoid.id != 0:
-            self.that_factoids[destination] = factoid
+            self.networks[irc_connection].that_factoids[destination] = factoid
     
     @staticmethod
     def onjoin_factoid(irc_connection, irc_message, arguments):
         destination = irc_message.response_destination
         bot = arguments["bot"]
         
-        should_send = bot.config_tree.findall("servers/server/channels/channel[@name='%s']" % (destination))[0].get("onjoin-factoid")
+        server_node = bot.networks[irc_connection].server_node
+        should_send = server_node.findall("channels/channel[@name='%s']" % (destination))[0].get("onjoin-factoid")
         
         if should_send == "true":
-            subject = irc_message.source.nick
-            
-            factoid_count = bot.db.count_factoids(subject)
-            
-            if factoid_count > 0:
-                bot.send_factoid(irc_connection, destination, subject)
+            bot.networks[irc_connection].command_scheduler.start(bot.send_onjoin_factoid(irc_connection, destination, irc_message.source.nick))
     
-    def add_factoid(self, irc_connection, irc_message, command_text):
-        separators_regex = re.compile("\s(" + "|".join(self.separators) + ")\s")
-        parts = separators_regex.split(command_text, 1)
+    async def send_onjoin_factoid(self, irc_connection, destination, subject):
+        factoid_count = await self.db.count_factoids(subject)
         
-        subject = parts[0].strip()
-        separator = parts[1].strip()
-        factoid = parts[2].strip()
+        if factoid_count > 0:
+            await self.send_factoid(irc_connection, destination, subject)
+    
+    async def add_factoid(self, irc_connection, irc_message, command_text):
+        network = self.networks[irc_connection]
+        (subject, separator, factoid) = network.command_matcher.split_factoid(command_text)
         
-        if self.db.is_subject_denied(subject):
+        if await self.db.is_subject_denied(subject):
             irc_connection.send_message(irc_message.response_destination, "Adding factoids for " + subject + " is not allowed")
             return
         
@@ -205,33 +460,34 @@ class Fastorbot(object):
             separator = "<action>"
         
         # Check if the factoid already exists
-        if self.db.factoid_exists(subject, separator, factoid):
+        if await self.db.factoid_exists(subject, separator, factoid):
             irc_connection.send_message(irc_message.response_destination, "That factoid already exists")
             return
         
         # Check if the subject already exists, adding it if it doesn't
-        subject_group = self.db.get_subject_group(subject)
-        if subject_group is None:
-            self.db.add_subject(subject)
-            subject_group = self.db.get_subject_group(subject)
+        subject_group = await self.db.get_or_add_subject_group(subject)
         
         who_added = irc_message.source.nick + " (" + irc_message.source.hostmask + ")"
         
-        new_id = self.db.add_factoid(subject, separator, factoid, who_added, subject_group)
+        new_id = await self.db.add_factoid(subject, separator, factoid, who_added, subject_group)
         irc_connection.send_message(irc_message.response_destination, "Factoid added about " + subject)
         
         # Store factoid in That array
-        factoid = self.db.get_factoid_by_id(new_id)
-        self.that_factoids[irc_message.response_destination] = factoid
+        factoid = await self.db.get_factoid_by_id(new_id)
+        network.that_factoids[irc_message.response_destination] = factoid
     
-    def command_that(self, irc_connection, irc_message, arguments, bot_user):
-        that_factoid = self.that_factoids[irc_message.response_destination]
+    async def command_that(self, irc_connection, irc_message, arguments, bot_user):
+        network = self.networks[irc_connection]
+        
+        that_factoid = network.that_factoids[irc_message.response_destination]
         
         if that_factoid is not None:
-            factoid_number = self.db.get_factoid_number(that_factoid)
+            factoid_number = await self.db.get_factoid_number(that_factoid)
             irc_connection.send_message(irc_message.destination, "That is factoid number %d about %s" % (factoid_number, that_factoid.subject))
     
-    def command_whoadded(self, irc_connection, irc_message, arguments, bot_user):
+    async def command_whoadded(self, irc_connection, irc_message, arguments, bot_user):
+        network = self.networks[irc_connection]
+        
         if len(arguments) == 1:
             subject = arguments[0]
         else:
@@ -240,15 +496,15 @@ class Fastorbot(object):
             return
         
         if subject == "that":
-            that_factoid = self.that_factoids[irc_message.response_destination]
+            that_factoid = network.that_factoids[irc_message.response_destination]
             
             if that_factoid is not None:
-                factoid_number = self.db.get_factoid_number(that_factoid)
+                factoid_number = await self.db.get_factoid_number(that_factoid)
                 factoid = that_factoid
         else:
             (subject, factoid_number) = Factoid.parse_subject_and_number(subject)
         
-            factoid = self.db.fetch_factoid(subject, factoid_number)
+            factoid = await self.db.fetch_factoid(subject, factoid_number)
             
             if factoid.id is None:
                 factoid.send(irc_connection, irc_message.response_destination)
@@ -256,7 +512,9 @@ class Fastorbot(object):
         
         irc_connection.send_message(irc_message.response_destination, "Factoid number %d about \"%s\" was added by %s on %s" % (factoid_number, factoid.subject, factoid.who_added, factoid.when_added))
     
-    def command_forget(self, irc_connection, irc_message, arguments, bot_user):
+    async def command_forget(self, irc_connection, irc_message, arguments, bot_user):
+        network = self.networks[irc_connection]
+        
         if len(arguments) == 1:
             factoid_identifier = arguments[0]
         else:
@@ -265,12 +523,12 @@ class Fastorbot(object):
             return
         
         if factoid_identifier == "that":
-            factoid = self.that_factoids[irc_message.response_destination]
+            factoid = network.that_factoids[irc_message.response_destination]
         else:
             factoid = None
         
         if factoid is not None:
-            rows_affected = self.db.delete_factoid_by_id(factoid.id)
+            rows_affected = await self.db.delete_factoid_by_id(factoid.id)
             
             if rows_affected == 1:
                 plural = ""
@@ -279,9 +537,9 @@ class Fastorbot(object):
             
             irc_connection.send_message(irc_message.response_destination, "Removed %d factoid%s for %s" % (rows_affected, plural, factoid.subject))
         
-            self.that_factoids[irc_message.response_destination] = None
+            network.that_factoids[irc_message.response_destination] = None
     
-    def command_count(self, irc_connection, irc_message, arguments, bot_user):
+    async def command_count(self, irc_connection, irc_message, arguments, bot_user):
         if len(arguments) == 1:
             subject = arguments[0]
         else:
@@ -289,7 +547,7 @@ class Fastorbot(object):
             irc_connection.send_notice(irc_message.source.nick, "Usage: count [subject]")
             return
         
-        factoid_count = self.db.count_factoids(subject)
+        factoid_count = await self.db.count_factoids(subject)
         
         if factoid_count == 1:
             plural = ""
@@ -300,14 +558,16 @@ class Fastorbot(object):
         
         irc_connection.send_message(irc_message.response_destination, "There %s %d factoid%s for %s" % (is_are, factoid_count, plural, subject))
     
-    def command_random(self, irc_connection, irc_message, arguments, bot_user):
-        factoid = self.db.fetch_random_factoid()
+    async def command_random(self, irc_connection, irc_message, arguments, bot_user):
+        network = self.networks[irc_connection]
+        
+        factoid = await self.db.fetch_random_factoid()
         factoid.send(irc_connection, irc_message.response_destination)
         
         # Store factoid in That array
-        self.that_factoids[irc_message.response_destination] = factoid
+        network.that_factoids[irc_message.response_destination] = factoid
     
-    def command_deny(self, irc_connection, irc_message, arguments, bot_user):
+    async def command_deny(self, irc_connection, irc_message, arguments, bot_user):
         if len(arguments) == 1:
             subject = arguments[0]
         else:
@@ -315,14 +575,14 @@ class Fastorbot(object):
             irc_connection.send_notice(irc_message.source.nick, "Usage: deny [subject]")
             return
         
-        rowcount = self.db.add_deny(subject)
+        rowcount = await self.db.add_deny(subject)
         
         if rowcount > 0:
             irc_connection.send_message(irc_message.response_destination, "Adding factoids for %s has been denied" % (subject))
         else:
             irc_connection.send_message(irc_message.response_destination, "An error occured")
     
-    def command_undeny(self, irc_connection, irc_message, arguments, bot_user):
+    async def command_undeny(self, irc_connection, irc_message, arguments, bot_user):
         if len(arguments) == 1:
             subject = arguments[0]
         else:
@@ -330,7 +590,7 @@ class Fastorbot(object):
             irc_connection.send_notice(irc_message.source.nick, "Usage: undeny [subject]")
             return
         
-        rowcount = self.db.remove_deny(subject)
+        rowcount = await self.db.remove_deny(subject)
         
         if rowcount > 0:
             irc_connection.send_message(irc_message.response_destination, "Adding factoids for %s is now allowed" % (subject))
@@ -341,7 +601,9 @@ class Fastorbot(object):
     # User management commands
     #####
     
-    def command_identify(self, irc_connection, irc_message, arguments, bot_user):
+    async def command_identify(self, irc_connection, irc_message, arguments, bot_user):
+        network = self.networks[irc_connection]
+        
         if len(arguments) == 1:
             username = irc_message.source.nick
             password = arguments[0]
@@ -353,18 +615,30 @@ class Fastorbot(object):
             irc_connection.send_notice(irc_message.source.nick, "Usage: identify [username] password")
             return
         
+        salt = await self.db.get_user_salt(username)
+        if salt is None:
+            irc_connection.send_notice(irc_message.source.nick, "Invalid username or password")
+            return
+        
+        # Hash the password on the hasher's thread pool
+        key_future = self.password_hasher.derive_keys([password], salt)
+        if key_future is None:
+            irc_connection.send_notice(irc_message.source.nick, "Too many password requests are in progress, try again in a moment")
+            return
+        
+        (user_key,) = await key_future
+        
         # Check the username and password
-        new_user = self.db.identify(username, password)
+        new_user = await self.db.identify(username, user_key)
         if new_user is not None:
-                irc_connection.send_notice(irc_message.source.nick, "You have been identified")
-                hostmask = irc_message.source.ident + "@" + irc_message.source.host
-                self.db.set_user_host(new_user.id, hostmask)
-                if hostmask not in self.identified_users:
-                    self.identified_users[hostmask] = new_user
+            irc_connection.send_notice(irc_message.source.nick, "You have been identified")
+            hostmask = irc_message.source.ident + "@" + irc_message.source.host
+            await self.db.set_user_host(new_user.id, hostmask, network.name)
+            network.identified_users.add_host(hostmask, new_user)
         else:
             irc_connection.send_notice(irc_message.source.nick, "Invalid username or password")
     
-    def command_add_user(self, irc_connection, irc_message, arguments, bot_user):
+    async def command_add_user(self, irc_connection, irc_message, arguments, bot_user):
         if len(arguments) == 1:
             username = arguments[0]
             flags = BotUser.FLAG_NONE
@@ -382,7 +656,17 @@ class Fastorbot(object):
             flags = flags.replace(BotUser.FLAG_BOTADMIN, "")
         
         password = Fastorbot.generate_password()
-        self.db.add_user(username, password, flags)
+        salt = PasswordHasher.generate_salt()
+        
+        # Hash the password on the hasher's thread pool
+        key_future = self.password_hasher.derive_keys([password], salt)
+        if key_future is None:
+            irc_connection.send_notice(irc_message.source.nick, "Too many password requests are in progress, try again in a moment")
+            return
+        
+        (user_key,) = await key_future
+        
+        await self.db.add_user(username, user_key, salt, flags)
         irc_connection.send_notice(irc_message.source.nick, "Added user " + username + " with password " + password + " and flags " + flags)
         irc_connection.send_notice(username, "Your username has been added with flags " + flags + ". Your temporary password is " + "password")
         irc_connection.send_notice(username, "Use '/msg " + irc_connection.nick + " password oldpass newpass' to change your password")
@@ -397,7 +681,7 @@ class Fastorbot(object):
 
         return password
     
-    def command_remove_user(self, irc_connection, irc_message, arguments, bot_user):
+    async def command_remove_user(self, irc_connection, irc_message, arguments, bot_user):
         if len(arguments) == 1:
             username = arguments[0]
         else:
@@ -405,19 +689,163 @@ class Fastorbot(object):
             irc_connection.send_notice(irc_message.source.nick, "Usage: deluser username")
             return
         
-        remove_user = self.db.get_user_by_name(username)
+        remove_user = await self.db.get_user_by_name(username)
         
-        if ((BotUser.FLAG_BOTADMIN in remove_user.flags) or (BotUser.FLAG_BOTMASTER in remove_user.flags)) and (BotUser.FLAG_BOTMASTER not in bot_user.flags):
+        if remove_user is None:
+            irc_connection.send_notice(irc_message.source.nick, "No such user: " + username)
+        elif ((BotUser.FLAG_BOTADMIN in remove_user.flags) or (BotUser.FLAG_BOTMASTER in remove_user.flags)) and (BotUser.FLAG_BOTMASTER not in bot_user.flags):
             irc_connection.send_notice(irc_message.source.nick, "You cannot remove admins or masters")
         else:
-            rowcount = self.db.remove_user(username)
+            rowcount = await self.db.remove_user(username)
             
             if rowcount > 0:
+                # The user's hosts and masks stop identifying anyone, and their channel flags stop applying, straight away
+                for network in self.get_network_list():
+                    network.identified_users.remove_user(remove_user.id)
+                    network.channel_flags.remove_user(remove_user.id)
+                
                 irc_connection.send_notice(irc_message.source.nick, "Removed user " + username)
             else:
                 irc_connection.send_notice(irc_message.source.nick, "No such user: " + username)
     
-    def command_password(self, irc_connection, irc_message, arguments, bot_user):
+    # Identified users can add masks that identify them from then on, so a changing address or cloak doesn't mean
+    # running identify each time; admins can manage other users' masks by giving a username first
+    async def command_add_mask(self, irc_connection, irc_message, arguments, bot_user):
+        target_user = await self.get_mask_command_user(irc_connection, irc_message, arguments, bot_user, "addmask")
+        if target_user is None:
+            return
+        
+        try:
+            mask = HostmaskIndex.normalize_mask(arguments[-1])
+        except ValueError as e:
+            irc_connection.send_notice(irc_message.source.nick, str(e))
+            return
+        
+        # Each mask identifies one user; adding it again would take it from whoever has it
+        network = self.networks[irc_connection]
+        mask_user = network.identified_users.get_mask_user(mask)
+        if (mask_user is not None) and (mask_user.id == target_user.id):
+            irc_connection.send_notice(irc_message.source.nick, "%s already has the mask %s" % (target_user.username, mask))
+            return
+        elif mask_user is not None:
+            irc_connection.send_notice(irc_message.source.nick, "The mask %s already belongs to another user" % (mask))
+            return
+        
+        await self.db.add_user_mask(target_user.id, mask, network.name)
+        network.identified_users.add_mask(mask, target_user)
+        
+        irc_connection.send_notice(irc_message.source.nick, "Added mask %s for %s" % (mask, target_user.username))
+    
+    async def command_remove_mask(self, irc_connection, irc_message, arguments, bot_user):
+        target_user = await self.get_mask_command_user(irc_connection, irc_message, arguments, bot_user, "delmask")
+        if target_user is None:
+            return
+        
+        # Masks are stored the way addmask normalized them, so they're looked up the same way
+        try:
+            mask = HostmaskIndex.normalize_mask(arguments[-1])
+        except ValueError as e:
+            irc_connection.send_notice(irc_message.source.nick, str(e))
+            return
+        
+        network = self.networks[irc_connection]
+        
+        rowcount = await self.db.remove_user_mask(target_user.id, mask, network.name)
+        if (rowcount > 0) and (mask in network.identified_users.get_user_masks(target_user.id)):
+            network.identified_users.remove_mask(mask)
+        
+        if rowcount > 0:
+            irc_connection.send_notice(irc_message.source.nick, "Removed mask %s for %s" % (mask, target_user.username))
+        else:
+            irc_connection.send_notice(irc_message.source.nick, "%s has no mask %s" % (target_user.username, mask))
+    
+    async def command_masks(self, irc_connection, irc_message, arguments, bot_user):
+        # The arguments are the same as addmask's without the mask
+        target_user = await self.get_mask_command_user(irc_connection, irc_message, arguments + [""], bot_user, "masks")
+        if target_user is None:
+            return
+        
+        masks = self.networks[irc_connection].identified_users.get_user_masks(target_user.id)
+        if len(masks) > 0:
+            irc_connection.send_notice(irc_message.source.nick, "Masks for %s: %s" % (target_user.username, ", ".join(masks)))
+        else:
+            irc_connection.send_notice(irc_message.source.nick, "%s has no masks" % (target_user.username))
+    
+    # Returns the user whose masks a command changes: the sender, or the user named before the mask if the sender is an admin
+    async def get_mask_command_user(self, irc_connection, irc_message, arguments, bot_user, command_name):
+        if len(arguments) == 1:
+            if bot_user.id == 0:
+                irc_connection.send_notice(irc_message.source.nick, "You need to identify first")
+                return None
+            
+            return bot_user
+        elif len(arguments) == 2:
+            if BotUser.FLAG_BOTADMIN not in bot_user.flags:
+                irc_connection.send_notice(irc_message.source.nick, "Only admins can change other users' masks")
+                return None
+            
+            target_user = await self.db.get_user_by_name(arguments[0])
+            if target_user is None:
+                irc_connection.send_notice(irc_message.source.nick, "No such user: " + arguments[0])
+            
+            return target_user
+        else:
+            irc_connection.send_notice(irc_message.source.nick, "Incorrect number of parameters")
+            if command_name == "masks":
+                irc_connection.send_notice(irc_message.source.nick, "Usage: masks [username]")
+            else:
+                irc_connection.send_notice(irc_message.source.nick, "Usage: %s [username] ident@host" % (command_name))
+            
+            return None
+    
+    # Channel flags let a user run a command in one channel without having its flag everywhere
+    async def command_grant(self, irc_connection, irc_message, arguments, bot_user):
+        await self.change_channel_flags(irc_connection, irc_message, arguments, "grant")
+    
+    async def command_revoke(self, irc_connection, irc_message, arguments, bot_user):
+        await self.change_channel_flags(irc_connection, irc_message, arguments, "revoke")
+    
+    async def change_channel_flags(self, irc_connection, irc_message, arguments, command_name):
+        if len(arguments) == 3:
+            (username, channel, flags) = arguments
+        else:
+            irc_connection.send_notice(irc_message.source.nick, "Incorrect number of parameters")
+            irc_connection.send_notice(irc_message.source.nick, "Usage: %s username #channel flags" % (command_name))
+            return
+        
+        if not channel.startswith("#"):
+            irc_connection.send_notice(irc_message.source.nick, "Invalid channel: " + channel)
+            return
+        
+        if (flags == "") or (flags.strip(BotUser.CHANNEL_FLAGS) != ""):
+            irc_connection.send_notice(irc_message.source.nick, "Flags that can be given for a channel: " + BotUser.CHANNEL_FLAGS)
+            return
+        
+        target_user = await self.db.get_user_by_name(username)
+        if target_user is None:
+            irc_connection.send_notice(irc_message.source.nick, "No such user: " + username)
+            return
+        
+        network = self.networks[irc_connection]
+        channel = channel.lower()
+        
+        flag_bits = network.channel_flags.get(target_user.id, channel)
+        if command_name == "grant":
+            flag_bits |= BotUser.get_flag_bits(flags)
+        else:
+            flag_bits &= ~BotUser.get_flag_bits(flags)
+        
+        flags = BotUser.get_flag_string(flag_bits)
+        
+        await self.db.set_user_channel_flags(target_user.id, channel, flags, network.name)
+        network.channel_flags.set(target_user.id, channel, flag_bits)
+        
+        if flags != "":
+            irc_connection.send_notice(irc_message.source.nick, "%s now has flags %s in %s" % (target_user.username, flags, channel))
+        else:
+            irc_connection.send_notice(irc_message.source.nick, "%s no longer has any flags in %s" % (target_user.username, channel))
+    
+    async def command_password(self, irc_connection, irc_message, arguments, bot_user):
         if len(arguments) == 2:
             username = irc_message.source.nick
             oldpass = arguments[0]
@@ -431,13 +859,30 @@ class Fastorbot(object):
             irc_connection.send_notice(irc_message.source.nick, "Usage: password [username] oldpass newpass")
             return
         
-        self.db.change_password(username, oldpass, newpass)
-        irc_connection.send_notice(irc_message.source.nick, "Your password has been changed")
+        salt = await self.db.get_user_salt(username)
+        if salt is None:
+            irc_connection.send_notice(irc_message.source.nick, "Invalid username or password")
+            return
+        
+        # Hash both passwords on the hasher's thread pool
+        key_future = self.password_hasher.derive_keys([oldpass, newpass], salt)
+        if key_future is None:
+            irc_connection.send_notice(irc_message.source.nick, "Too many password requests are in progress, try again in a moment")
+            return
+        
+        (old_key, new_key) = await key_future
+        
+        rowcount = await self.db.change_password(username, old_key, new_key)
+        
+        if rowcount > 0:
+            irc_connection.send_notice(irc_message.source.nick, "Your password has been changed")
+        else:
+            irc_connection.send_notice(irc_message.source.nick, "Invalid username or password")
     
     #####
     # Administration commands
     #####
-    def command_ignore(self, irc_connection, irc_message, arguments, bot_user):
+    async def command_ignore(self, irc_connection, irc_message, arguments, bot_user):
         if len(arguments) == 2:
             nick = arguments[0]
             try:
@@ -457,32 +902,16 @@ class Fastorbot(object):
         
         if nick in irc_connection.users:
             host = irc_connection.users[nick].host
-            
-            if host is None:
-                if nick not in irc_connection.waiting_for_whois:
-                    irc_connection.send_whois(nick)
-                else:
-                    irc_connection.waiting_for_whois[nick] += 1
-                
-                # Wait for the whois to return, maximum 10 seconds
-                if irc_connection.waiting_for_whois[nick] < 10:
-                    irc_connection.loop.call_later(1, self.command_ignore, irc_connection, irc_message, arguments, bot_user)
-                    return
-        else:
-            if nick not in irc_connection.waiting_for_whois:
-                irc_connection.send_whois(nick)
-            else:
-                irc_connection.waiting_for_whois[nick] += 1
-            
-            # Wait for the whois to return, maximum 10 seconds
-            if irc_connection.waiting_for_whois[nick] < 10:
-                irc_connection.loop.call_later(1, self.command_ignore, irc_connection, irc_message, arguments, bot_user)
-                return
+        
+        if host is None:
+            irc_user = await irc_connection.whois(nick)
+            if irc_user is not None:
+                host = irc_user.host
         
         if host is not None:
+            endtime = min(int(time.time()) + duration * 60, IgnoreList.MAX_ENDTIME)
+            
             try:
-                endtime = datetime.datetime.now() + datetime.timedelta(minutes=duration)
-                
                 duration_temp = duration
                 duration_millenia = math.floor(duration_temp / 525600000)
                 duration_temp -= math.floor(duration_temp / 525600000) * 525600000
@@ -528,16 +957,16 @@ class Fastorbot(object):
                 elif duration_minutes > 0:
                     duration_string += "%d minute " % (duration_minutes)
             except OverflowError:
-                endtime = datetime.datetime.max
                 duration_string = "a really long time."
             
-            self.db.add_ignore(nick, host, endtime, irc_message.source.to_userinfo())
+            await self.db.add_ignore(nick, host, endtime, irc_message.source.to_userinfo())
+            self.ignore_list.add(host, endtime)
             
             irc_connection.send_message(irc_message.response_destination, "%s (%s) is being ignored for %s" % (nick, host, duration_string))
         else:
             irc_connection.send_message(irc_message.response_destination, "Could not determine host for %s" % (nick))
     
-    def command_unignore(self, irc_connection, irc_message, arguments, bot_user):
+    async def command_unignore(self, irc_connection, irc_message, arguments, bot_user):
         if len(arguments) == 1:
             nick = arguments[0]
         else:
@@ -546,7 +975,8 @@ class Fastorbot(object):
             return
         
         host = irc_connection.users[nick].host
-        self.db.remove_ignore(nick, host)
+        await self.db.remove_ignore(nick, host)
+        self.ignore_list.remove(host)
         
         irc_connection.send_message(irc_message.response_destination, "%s (%s) is no longer being ignored" % (nick, host))
     
@@ -560,171 +990,146 @@ class Fastorbot(object):
         else:
             nick = irc_message.source.nick
         
-        lameness_points = 0
-        
-        special_costs = {
-            "69": 2000,
-            "dea?th": 500,
-            "dark": 500,
-            "n[i1]ght": 500,
-            "n[i1]te": 750,
-            "fuck": 5000,
-            "sh[i1]t": 5000,
-            "coo[l1]": 1000,
-            "kew[l1]": 1000,
-            "lame": 500,
-            "d(oo)|(00)d": 1500,
-            "dude": 1000,
-            "rool[sz]": 1500,
-            "rule[sz]": 1000,
-            "[l1](oo?|u)[sz]er": 1000,
-            "[l1]eet": 1500,
-            "e[l1]ite": 750,
-            "[l1]ord": 500,
-            "k[i1]ng": 500,
-            "pron": 2000,
-            "warez": 2500,
-            "xx": 250,
-            "[rkx]0": 500,
-            "0[rkx]": 500,
-            "[Cc][Hh][Oo][Bb][Oo]": 10**20
-        }
-        
-        for (pattern, cost) in special_costs.items():
-            matches = re.findall(pattern, nick)
-            lameness_points += len(matches) * special_costs[pattern]
-        
-        # Punish consecutive non-alphas
-        matches = re.findall("[^A-Za-z0-9]{2,}", nick)
-        for match in matches:
-            lameness_points += 100 * 2**len(match)
-        
-        # Starts with one or more digits
-        match = re.search("^\d+", nick)
-        if match is not None:
-            lameness_points += 100 * 1.2**len(match.group(0))
-        
-        # Starts with non-alphanumeric
-        match = re.search("^[^A-Za-z0-9]+", nick)
-        if match is not None:
-            lameness_points += 500 * 1.5**len(match.group(0))
-        
-        # Ends with non-alphanumeric
-        match = re.search("[^A-Za-z0-9]+$", nick)
-        if match is not None:
-            lameness_points += 250 * 1.3**len(match.group(0))
-        
-        # Changes in character type
-        num_case_shifts = len(re.findall("[a-z][A-Z]", nick))
-        num_case_shifts += len(re.findall("[A-Z][a-z]", nick))
-        if num_case_shifts > 1:
-            lameness_points += 50 * 1.2**num_case_shifts
-        
-        num_alnum_shifts = len(re.findall("[a-zA-Z][0-9]", nick))
-        num_alnum_shifts += len(re.findall("[0-9][a-zA-Z]", nick))
-        if num_alnum_shifts > 0:
-            lameness_points += 100 * 1.2**num_alnum_shifts
-        
-        num_symbol_shifts = len(re.findall("[a-zA-Z0-9][^a-zA-Z0-9]", nick))
-        num_symbol_shifts += len(re.findall("[^a-zA-Z0-9][a-zA-Z0-9]", nick))
-        if num_symbol_shifts > 0:
-            lameness_points += 250 * 1.8**num_symbol_shifts
-        
-        matches = re.findall("[A-Z]{2,}", nick)
-        for match in matches:
-            lameness_points += 100 * 1.3**len(match)
-        
-        matches = re.findall("[^a-zA-Z0-9\(\)\[\]\{\}]", nick)
-        if len(matches) > 0:
-            lameness_points += 250 * 1.8**len(matches)
-        
-        #lameness_score = round(200 * (math.atan(lameness_points / 1000) / math.pi), 2)
-        lameness_score = round(6400 * (math.atan(lameness_points / 1000) / math.pi)**6, 2)
-        lameness_points = round(lameness_points)
+        (lameness_points, lameness_score) = self.lame_nick.get_score(nick)
         
         irc_connection.send_message(irc_message.response_destination, "The nickname %s scored %d lameness points, for a lameness rating of %d%%" % (nick, lameness_points, lameness_score))
     
+    # Rolls dice given as terms such as "2d6+3" or "4d6k3 + 1d4"; spaces between terms are allowed
     def command_roll_dice(self, irc_connection, irc_message, arguments, bot_user):
-        if len(arguments) == 1:
-            roll_string = arguments[0]
-            roll_match = re.match("(\d+)d(\d+)", roll_string)
-            
-            if roll_match is not None:
-                num_dice = int(roll_match.group(1))
-                sides = int(roll_match.group(2))
-            else:
-                irc_connection.send_notice(irc_message.source.nick, "Incorrect roll format")
-                irc_connection.send_notice(irc_message.source.nick, "Usage: roll <num>d<num>")
-                return
-        else:
-            irc_connection.send_notice(irc_message.source.nick, "Incorrect number of parameters")
-            irc_connection.send_notice(irc_message.source.nick, "Usage: roll <num>d<num>")
-            return
+        roll_string = " ".join(arguments)
         
-        total = 0
-        for i in range(0, num_dice):
-            die = random.randint(1, sides)
-            total += die
+        try:
+            total = self.dice_roller.roll(roll_string)
+        except ValueError as e:
+            irc_connection.send_notice(irc_message.source.nick, str(e))
+            irc_connection.send_notice(irc_message.source.nick, "Usage: roll <num>d<sides>[k<keep>] [+ <num>d<sides> | + <num>]...")
+            return
         
-        irc_connection.send_message(irc_message.response_destination, "Rolled %dd%d for %d" % (num_dice, sides, total))
+        irc_connection.send_message(irc_message.response_destination, "Rolled %s for %d" % (roll_string.replace(" ", ""), total))
     
     def command_time(self, irc_connection, irc_message, arguments, bot_user):
         irc_connection.send_message(irc_message.response_destination, "The current time is " + datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     
     def command_startpoll(self, irc_connection, irc_message, arguments, bot_user):
-        if self.current_poll is not None:
+        network = self.networks[irc_connection]
+        
+        if network.current_poll is not None:
             irc_connection.send_message(irc_message.response_destination, "There's already an active poll; use \'endpoll\' to end it")
             return
         
-        self.current_poll = dict()
-        self.current_poll["question"] = arguments[0]
+        if len(arguments) == 0:
+            irc_connection.send_notice(irc_message.source.nick, "Usage: startpoll question [choice ...]")
+            return
+        
+        network.current_poll = dict()
+        network.current_poll["question"] = arguments[0]
         
         if len(arguments) > 1:
             poll_choices = arguments[1:]
         else:
             poll_choices = ["Yes", "No"]
         
-        self.current_poll["choices"] = dict()
+        network.current_poll["choices"] = dict()
         for choice_number in range(1, len(poll_choices) + 1):
-            self.current_poll["choices"][choice_number] = dict()
-            self.current_poll["choices"][choice_number]["text"] = poll_choices[choice_number - 1]
-            self.current_poll["choices"][choice_number]["votes"] = 0
+            network.current_poll["choices"][choice_number] = dict()
+            network.current_poll["choices"][choice_number]["text"] = poll_choices[choice_number - 1]
+            network.current_poll["choices"][choice_number]["votes"] = 0
         
-        irc_connection.send_message(irc_message.response_destination, "Poll started for the question \"%s\"" % (self.current_poll["question"]))
+        irc_connection.send_message(irc_message.response_destination, "Poll started for the question \"%s\"" % (network.current_poll["question"]))
         irc_connection.send_message(irc_message.response_destination, "To vote, type \"%s, poll N\" (where N is the number of your choice)" % (irc_connection.nick))
         
-        for (choice_number, choice) in self.current_poll["choices"].items():
+        for (choice_number, choice) in network.current_poll["choices"].items():
             irc_connection.send_message(irc_message.response_destination, "(%d) %s" % (choice_number, choice["text"]))
         
     def command_poll_choose(self, irc_connection, irc_message, arguments, bot_user):
-        if self.current_poll is None:
+        network = self.networks[irc_connection]
+        
+        if network.current_poll is None:
             irc_connection.send_message(irc_message.response_destination, "There is no active poll; use \'startpoll\' to start one")
             return
         
+        if len(arguments) != 1:
+            irc_connection.send_notice(irc_message.source.nick, "Usage: poll N")
+            return
+        
         try:
             choice = int(arguments[0])
         except ValueError:
             irc_connection.send_notice(irc_message.source.nick, "Invalid choice")
             return
         
-        self.current_poll["choices"][choice]["votes"] += 1
+        if choice not in network.current_poll["choices"]:
+            irc_connection.send_notice(irc_message.source.nick, "Invalid choice")
+            return
+        
+        network.current_poll["choices"][choice]["votes"] += 1
         irc_connection.send_notice(irc_message.source.nick, "Your vote has been recorded")
         
     def command_endpoll(self, irc_connection, irc_message, arguments, bot_user):
-        if self.current_poll is None:
+        network = self.networks[irc_connection]
+        
+        if network.current_poll is None:
             irc_connection.send_message(irc_message.response_destination, "There is no active poll; use \'startpoll\' to start one")
             return
         
-        irc_connection.send_message(irc_message.response_destination, "Results for the question \"%s\"" % (self.current_poll["question"]))
+        irc_connection.send_message(irc_message.response_destination, "Results for the question \"%s\"" % (network.current_poll["question"]))
         
-        for (choice_number, choice) in self.current_poll["choices"].items():
+        for (choice_number, choice) in network.current_poll["choices"].items():
             irc_connection.send_message(irc_message.response_destination, "%d votes for (%d) %s" % (choice["votes"], choice_number, choice["text"]))
             
-        self.current_poll = None
+        network.current_poll = None
     
     #####
     # Bot control commands
     #####
+    def command_cachestats(self, irc_connection, irc_message, arguments, bot_user):
+        if self.factoid_cache is not None:
+            irc_connection.send_message(irc_message.response_destination, "Factoid cache: %d subjects, %d hits, %d misses, %d evictions" % (len(self.factoid_cache.entries), self.factoid_cache.hits, self.factoid_cache.misses, self.factoid_cache.evictions))
+        else:
+            irc_connection.send_message(irc_message.response_destination, "The factoid cache is disabled")
+    
+    def command_lag(self, irc_connection, irc_message, arguments, bot_user):
+        if irc_connection.lag is None:
+            irc_connection.send_message(irc_message.response_destination, "Lag to %s hasn't been measured yet" % (irc_connection.hostname))
+            return
+        
+        lag_histogram = irc_connection.lag_histogram
+        irc_connection.send_message(irc_message.response_destination, "Lag to %s is %.3f seconds (%d pings: mean %.3f, 50%% under %.3f, 95%% under %.3f, max %.3f)" % (
+            irc_connection.hostname,
+            irc_connection.lag,
+            lag_histogram.count,
+            lag_histogram.mean(),
+            lag_histogram.percentile(50),
+            lag_histogram.percentile(95),
+            lag_histogram.max
+        ))
+    
+    # Lists metrics whose names start with an optional prefix, e.g. "stats db."
+    def command_stats(self, irc_connection, irc_message, arguments, bot_user):
+        if len(arguments) > 0:
+            prefix = arguments[0]
+        else:
+            prefix = ""
+        
+        lines = self.metrics.format_lines(prefix)
+        if len(lines) == 0:
+            irc_connection.send_notice(irc_message.source.nick, "No metrics match \"%s\"" % (prefix))
+            return
+        
+        for line in lines[:Fastorbot.MAX_STATS_LINES]:
+            irc_connection.send_notice(irc_message.source.nick, line)
+        
+        if len(lines) > Fastorbot.MAX_STATS_LINES:
+            irc_connection.send_notice(irc_message.source.nick, "%d more metrics not shown; use 'stats prefix' to narrow the list" % (len(lines) - Fastorbot.MAX_STATS_LINES))
+    
+    def dump_metrics(self):
+        try:
+            self.metrics.dump(self.metrics_dump_file)
+        except OSError:
+            self.logger.exception("Could not write metrics to %s", self.metrics_dump_file)
+        
+        self.loop.call_later(self.metrics_dump_interval, self.dump_metrics)
+    
     def command_quit(self, irc_connection, irc_message, arguments, bot_user):
         self.quit()
     
@@ -733,14 +1138,20 @@ class Fastorbot(object):
         self.quit()
     
     def quit(self):
-        self.db.close()
-        self.irc_connection.disconnect()
-        time.sleep(5)
-        sys.exit(0)
+        if self.loop is None:
+            self.db.close()
+            self.password_hasher.close()
+            self.log_pipeline.stop()
+            sys.exit(0)
+        
+        for network in self.get_network_list():
+            network.irc_connection.disconnect()
+        
+        # Give the QUIT messages time to be sent; irc_connect() closes the database once the loop stops
+        self.loop.call_later(5, self.loop.stop)
     
     def on_end_motd(self, irc_connection, irc_message):
-        server_node = self.config_tree.findall("servers")[0].findall("server")[0]
+        server_node = self.networks[irc_connection].server_node
         channel_nodes = server_node.findall("channels/channel")
         
-        for n in channel_nodes:
-            irc_connection.join_channel(n.get("name"))
+        irc_connection.join_channels([n.get("name") for n in channel_nodes])
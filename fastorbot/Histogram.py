@@ -0,0 +1,58 @@
+import bisect
+
+class Histogram(object):
+    # Counts observed values in buckets with fixed upper bounds; values above the last bound go in an overflow bucket
+    def __init__(self, bounds):
+        self.bounds = sorted(bounds)
+        self.bucket_counts = [0] * (len(self.bounds) + 1)
+        
+        self.count = 0
+        self.sum = 0
+        self.max = None
+    
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.bounds, value)] += 1
+        
+        self.count += 1
+        self.sum += value
+        if (self.max is None) or (value > self.max):
+            self.max = value
+    
+    def mean(self):
+        if self.count == 0:
+            return None
+        
+        return self.sum / self.count
+    
+    # Returns the upper bound of the bucket containing the given percentile (0-100), or the largest value seen
+    # if the percentile falls in the overflow bucket
+    def percentile(self, percentile):
+        if self.count == 0:
+            return None
+        
+        rank = self.count * percentile / 100
+        seen = 0
+        
+        for (bucket, bucket_count) in enumerate(self.bucket_counts):
+            seen += bucket_count
+            if (seen >= rank) and (bucket_count > 0):
+                if bucket < len(self.bounds):
+                    return self.bounds[bucket]
+                else:
+                    return self.max
+        
+        return self.max
+    
+    # Returns a list of (upper bound, count of values up to and including it); the last bound is None for the overflow bucket
+    def cumulative_counts(self):
+        counts = list()
+        seen = 0
+        
+        for (bucket, bucket_count) in enumerate(self.bucket_counts):
+            seen += bucket_count
+            if bucket < len(self.bounds):
+                counts.append((self.bounds[bucket], seen))
+            else:
+                counts.append((None, seen))
+        
+        return counts
@@ -0,0 +1,213 @@
+import re
+
+class HostmaskIndex(object):
+    # Masks must name at least this many host labels without wildcards, so "*@*" or "*@*.com" can't match everyone
+    MIN_LITERAL_LABELS = 2
+    
+    # Lookups that go as far as the masks are remembered, until the masks change or this many hostmasks have been looked up
+    MAX_CACHED_LOOKUPS = 4096
+    
+    # Finds the BotUser for an ident@host, either from the exact hostmask a user identified from, or from a mask with
+    # * and ? wildcards that the user added
+    # Exact hostmasks are kept in a dict. Masks are kept in a trie keyed by the host's labels starting from the most
+    # significant one (from the right for names, from the left for IPv4 addresses), each mask at the node for its
+    # labels up to the first one with a wildcard; a lookup only tries the masks on its own host's path through the trie
+    def __init__(self):
+        # Hostmask -> BotUser
+        self.exact_hosts = dict()
+        
+        self.mask_trie = HostmaskTrieNode()
+        
+        # Mask -> (BotUser, compiled pattern)
+        self.masks = dict()
+        
+        # Hostmask -> BotUser or None, for lookups that needed the masks
+        self.lookup_cache = dict()
+    
+    def get(self, hostmask, default=None):
+        bot_user = self.exact_hosts.get(hostmask)
+        if bot_user is not None:
+            return bot_user
+        
+        if len(self.masks) == 0:
+            return default
+        
+        if hostmask in self.lookup_cache:
+            bot_user = self.lookup_cache[hostmask]
+        else:
+            bot_user = self.match_mask(hostmask)
+            
+            if len(self.lookup_cache) >= HostmaskIndex.MAX_CACHED_LOOKUPS:
+                self.lookup_cache.clear()
+            
+            self.lookup_cache[hostmask] = bot_user
+        
+        if bot_user is None:
+            return default
+        
+        return bot_user
+    
+    def __contains__(self, hostmask):
+        return self.get(hostmask) is not None
+    
+    def __len__(self):
+        return len(self.exact_hosts) + len(self.masks)
+    
+    # Records the exact hostmask a user identified from
+    def add_host(self, hostmask, bot_user):
+        self.exact_hosts[hostmask] = bot_user
+    
+    def add_mask(self, mask, bot_user):
+        mask = mask.lower()
+        if mask in self.masks:
+            self.remove_mask(mask)
+        
+        self.masks[mask] = (bot_user, HostmaskIndex.compile_mask(mask))
+        
+        node = self.mask_trie
+        for label in HostmaskIndex.get_mask_key(mask):
+            node = node.children.setdefault(label, HostmaskTrieNode())
+        
+        node.masks.append(mask)
+        
+        self.lookup_cache.clear()
+    
+    # Returns True if the mask was in the index
+    def remove_mask(self, mask):
+        mask = mask.lower()
+        if mask not in self.masks:
+            return False
+        
+        del self.masks[mask]
+        
+        # Empty nodes are left in place; they cost nothing but a little memory
+        node = self.mask_trie
+        for label in HostmaskIndex.get_mask_key(mask):
+            node = node.children[label]
+        
+        node.masks.remove(mask)
+        
+        self.lookup_cache.clear()
+        
+        return True
+    
+    # Forgets every host and mask belonging to a user
+    def remove_user(self, user_id):
+        for hostmask in [hostmask for (hostmask, bot_user) in self.exact_hosts.items() if bot_user.id == user_id]:
+            del self.exact_hosts[hostmask]
+        
+        for mask in [mask for (mask, (bot_user, pattern)) in self.masks.items() if bot_user.id == user_id]:
+            self.remove_mask(mask)
+    
+    # Returns the BotUser a mask belongs to, or None if no one has it
+    def get_mask_user(self, mask):
+        entry = self.masks.get(mask.lower())
+        if entry is None:
+            return None
+        
+        return entry[0]
+    
+    # Returns a list of the masks belonging to a user
+    def get_user_masks(self, user_id):
+        return sorted(mask for (mask, (bot_user, pattern)) in self.masks.items() if bot_user.id == user_id)
+    
+    # Returns the BotUser of the first mask that matches, trying the most specific masks first
+    def match_mask(self, hostmask):
+        hostmask = hostmask.lower()
+        (ident, at, host) = hostmask.rpartition("@")
+        
+        nodes = [self.mask_trie]
+        node = self.mask_trie
+        for label in HostmaskIndex.get_host_key(host):
+            node = node.children.get(label)
+            if node is None:
+                break
+            
+            nodes.append(node)
+        
+        for node in reversed(nodes):
+            for mask in node.masks:
+                (bot_user, pattern) = self.masks[mask]
+                if pattern.fullmatch(hostmask) is not None:
+                    return bot_user
+        
+        return None
+    
+    # Masks are ident@host; IRC's nick!ident@host form is accepted when the nick is a wildcard, since the index only
+    # sees ident@host. Returns the mask in the form that's stored, or raises ValueError with a message for the user
+    @staticmethod
+    def normalize_mask(mask):
+        mask = mask.lower()
+        
+        if "!" in mask:
+            (nick, exclamation, mask) = mask.partition("!")
+            if nick != "*":
+                raise ValueError("Masks match ident@host, so the nick part must be *")
+        
+        (ident, at, host) = mask.partition("@")
+        if (at == "") or (ident == "") or (host == "") or ("@" in host) or (" " in mask):
+            raise ValueError("Masks look like ident@host, with * and ? as wildcards")
+        
+        if HostmaskIndex.has_wildcard(host) and (len(HostmaskIndex.get_mask_key(mask)) < HostmaskIndex.MIN_LITERAL_LABELS):
+            raise ValueError("A mask's host needs at least %d parts without wildcards, like *@*.example.com or *@192.168.*.*" % (HostmaskIndex.MIN_LITERAL_LABELS))
+        
+        return mask
+    
+    @staticmethod
+    def has_wildcard(text):
+        return ("*" in text) or ("?" in text)
+    
+    # Returns a list of a host's labels, most significant first
+    @staticmethod
+    def get_host_key(host):
+        labels = host.split(".")
+        
+        if HostmaskIndex.is_ipv4_labels(labels):
+            return labels
+        else:
+            labels.reverse()
+            return labels
+    
+    # Returns a list of a mask's host labels, most significant first, up to the first one with a wildcard
+    @staticmethod
+    def get_mask_key(mask):
+        host = mask.rpartition("@")[2]
+        labels = host.split(".")
+        
+        if not HostmaskIndex.is_ipv4_labels(labels):
+            labels.reverse()
+        
+        key = list()
+        for label in labels:
+            if HostmaskIndex.has_wildcard(label):
+                break
+            
+            key.append(label)
+        
+        return key
+    
+    # Labels of an IPv4 address, or of a mask for one such as 192.168.*.*
+    @staticmethod
+    def is_ipv4_labels(labels):
+        if len(labels) != 4:
+            return False
+        
+        for label in labels:
+            if (label == "") or (label.strip("0123456789*?") != ""):
+                return False
+        
+        return True
+    
+    @staticmethod
+    def compile_mask(mask):
+        return re.compile(re.escape(mask).replace("\\*", ".*").replace("\\?", "."), re.DOTALL)
+
+class HostmaskTrieNode(object):
+    __slots__ = ("children", "masks")
+    
+    def __init__(self):
+        # Label -> HostmaskTrieNode
+        self.children = dict()
+        
+        # Masks whose literal labels end at this node
+        self.masks = list()
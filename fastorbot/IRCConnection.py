@@ -1,21 +1,45 @@
 import asyncio
 import datetime
 import logging
+import random
 import sys
 import time
 
+from fastorbot.Histogram import *
 from fastorbot.IRCCallback import *
 from fastorbot.IRCChannel import *
+from fastorbot.IRCLineFramer import *
 from fastorbot.IRCMessage import *
 from fastorbot.IRCProtocol import *
+from fastorbot.IRCSendQueue import *
 from fastorbot.IRCUser import *
 
 class IRCConnection(object):
-    def __init__(self, hostname, hostport, nick):
-        self.hostname = hostname
-        self.hostport = hostport
+    # Reconnect delays grow exponentially from the minimum to the maximum, in seconds, with random jitter
+    RECONNECT_MIN_DELAY = 5
+    RECONNECT_MAX_DELAY = 300
+    
+    # Seconds to wait for a host to accept the connection before trying the next one
+    CONNECT_TIMEOUT = 30
+    
+    # Longest JOIN line to send, leaving room for the CRLF in the 512 byte limit
+    MAX_JOIN_LENGTH = 510
+    
+    # Upper bounds of the lag histogram's buckets, in seconds
+    LAG_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+    
+    # Seconds whois() waits for the server to answer
+    WHOIS_TIMEOUT = 10
+    
+    # hosts is a list of (hostname, port) tuples for the network's servers, tried in order until one connects
+    # After keepalive_interval seconds without hearing from the server the bot sends it a PING, and reconnects
+    # if no PONG arrives within keepalive_timeout seconds
+    def __init__(self, hosts, nick, send_queue=None, keepalive_interval=60, keepalive_timeout=30):
+        self.hosts = hosts
+        self.host_index = 0
+        (self.hostname, self.hostport) = hosts[0]
         
-        self.server_name = hostname
+        self.server_name = self.hostname
         
         self.nick = nick
         self.ident = self.nick
@@ -25,7 +49,15 @@ class IRCConnection(object):
         self.users = dict()
         self.current_channels = dict()
         
-        self.server_data_buffer = ""
+        self.logger = logging.getLogger('fastorbot')
+        
+        self.line_framer = IRCLineFramer()
+        
+        # Outgoing lines are rate limited to stay under the server's flood limits
+        if send_queue is not None:
+            self.send_queue = send_queue
+        else:
+            self.send_queue = IRCSendQueue()
         
         self.callbacks = dict()
         
@@ -38,86 +70,182 @@ class IRCConnection(object):
         self.add_callback("366", IRCCallback(IRCConnection.irc_callback_channel_end_users))
         self.add_callback("311", IRCCallback(IRCConnection.irc_callback_whois_user))
         self.add_callback("318", IRCCallback(IRCConnection.irc_callback_whois_end))
+        self.add_callback("001", IRCCallback(IRCConnection.irc_callback_welcome))
+        self.add_callback("PONG", IRCCallback(IRCConnection.irc_callback_pong))
         
+        # Nick -> list of futures waiting for the reply to the WHOIS sent for it
         self.waiting_for_whois = dict()
+        
+        self.loop = None
+        self.transport = None
+        self.quitting = False
+        
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_timeout = keepalive_timeout
+        self.keepalive_handle = None
+        self.last_activity = 0
+        
+        # Token and send time of the PING waiting for a PONG, if any
+        self.ping_token = None
+        self.ping_sent_time = None
+        self.ping_count = 0
+        
+        # Round trip time of the most recent PING, in seconds
+        self.lag = None
+        self.lag_histogram = Histogram(IRCConnection.LAG_BUCKETS)
+        
+        self.connect_task = None
+        self.failed_attempts = 0
+        
+        # Totals for the life of the bot, across reconnects
+        self.lines_received = 0
+        self.reconnect_count = 0
     
     def set_owner(self, owner):
         self.owner = owner
     
+    # Starts connecting in the background; the caller runs the event loop, which may be shared with other connections
     def connect(self):
         self.loop = asyncio.get_event_loop()
-        self.coroutine = self.loop.create_connection(lambda: IRCProtocol(self.loop, self), self.hostname, self.hostport)
+        self.quitting = False
         
-        # Set timer to check for a disconnection (no data for ten minutes) every minute
-        self.loop.call_later(60, self.check_connection_timeout)
-        self.last_activity = datetime.datetime.now()
+        self.start_connect_task(0)
+    
+    def start_connect_task(self, delay):
+        if (self.connect_task is not None) and not self.connect_task.done():
+            return
         
-        self.loop.run_until_complete(self.coroutine)
-        self.loop.run_forever()
+        self.connect_task = self.loop.create_task(self.connect_to_host(delay))
+    
+    # Returns the delay before the next connection attempt: exponential in the number of failed attempts,
+    # with the upper half randomized so connections that dropped together don't all retry together
+    def get_reconnect_delay(self):
+        delay = min(IRCConnection.RECONNECT_MAX_DELAY, IRCConnection.RECONNECT_MIN_DELAY * (2 ** min(self.failed_attempts, 16)))
+        return (delay / 2) + random.uniform(0, delay / 2)
+    
+    async def connect_to_host(self, delay):
+        while not self.quitting:
+            if delay > 0:
+                self.log_message("Connecting to %s:%s in %.1f seconds", self.hosts[self.host_index][0], self.hosts[self.host_index][1], delay)
+                await asyncio.sleep(delay)
+            
+            (hostname, hostport) = self.hosts[self.host_index]
+            
+            try:
+                await asyncio.wait_for(self.loop.create_connection(lambda: IRCProtocol(self.loop, self), hostname, hostport), IRCConnection.CONNECT_TIMEOUT)
+                self.hostname = hostname
+                self.hostport = hostport
+                return
+            except (OSError, asyncio.TimeoutError) as e:
+                self.log_message("Could not connect to %s:%s: %r", hostname, hostport, e)
+            
+            # Move on to the next host, and wait longer each time
+            self.host_index = (self.host_index + 1) % len(self.hosts)
+            delay = self.get_reconnect_delay()
+            self.failed_attempts += 1
     
     def on_connect(self, transport):
         self.transport = transport
+        self.send_queue.start(self.loop, transport)
+        
+        self.last_activity = self.loop.time()
+        self.schedule_keepalive(self.keepalive_interval)
         self.put_message("USER " + self.ident + " " + self.local_hostname + " " + self.server_name + " :" + self.real_name)
         self.put_message("NICK " + self.nick)
     
     def disconnect(self, quit_message="Fastorbot Version 0.1"):
+        self.quitting = True
+        
+        if (self.connect_task is not None) and not self.connect_task.done():
+            self.connect_task.cancel()
+        
         self.put_message("QUIT :" + quit_message)
     
     def on_receive(self, data):
-        try:
-            data_string = data.decode(errors="replace")
-        except UnicodeDecodeError:
-            return
-        
-        irc_messages = self.parse_server_data(data_string)
+        irc_messages = self.parse_server_data(data)
         for irc_message in irc_messages:
             self.handle_message(irc_message)
     
     def on_disconnect(self, exc):
-        self.reconnect()
+        self.transport = None
+        self.reset_connection_state()
+        
+        if not self.quitting:
+            # A connection that never got as far as registering counts as a failed attempt, so a server
+            # that accepts and then drops the connection is retried with the same backoff as one that refuses it
+            delay = self.get_reconnect_delay()
+            self.failed_attempts += 1
+            self.reconnect_count += 1
+            self.start_connect_task(delay)
+        
+        self.owner.on_disconnect(self)
     
+    # Everything learned from the server is only valid for the connection it came from
+    def reset_connection_state(self):
+        if self.keepalive_handle is not None:
+            self.keepalive_handle.cancel()
+            self.keepalive_handle = None
+        
+        self.ping_token = None
+        self.ping_sent_time = None
+        self.lag = None
+        
+        self.send_queue.stop()
+        self.line_framer.reset()
+        self.current_channels.clear()
+        self.users.clear()
+        
+        for futures in self.waiting_for_whois.values():
+            for future in futures:
+                future.cancel()
+        
+        self.waiting_for_whois.clear()
+    
+    def on_pause_writing(self):
+        self.send_queue.pause_writing()
+    
+    def on_resume_writing(self):
+        self.send_queue.resume_writing()
+    
+    # Closing the transport calls on_disconnect, which connects again
     def reconnect(self):
-        self.disconnect()
-        time.sleep(5)
-        self.connect()
+        if self.transport is not None:
+            self.transport.close()
     
-    def parse_server_data(self, data_string):
-        # Set last activity timer
-        self.last_activity = datetime.datetime.now()
+    def parse_server_data(self, data):
+        # Any data from the server shows the connection is alive; the keepalive timer checks this when it fires,
+        # rather than being rescheduled for every read
+        self.last_activity = self.loop.time()
         
-        self.server_data_buffer += data_string
+        started = time.perf_counter()
         
-        messages = self.server_data_buffer.split("\r\n")
+        # Incomplete lines stay in the framer until the rest of the line arrives
+        messages = self.line_framer.feed(data)
         irc_messages = list()
         
-        # If the buffer doesn't end with \r\n, the last message is incomplete
-        # Take the last (partial) message in the buffer and leave it in the buffer
-        if not self.server_data_buffer.endswith("\r\n"):
-            self.server_data_buffer = messages.pop()
-        else:
-            self.server_data_buffer = ""
-        
         for message in messages:
-            if message == "":
-                continue
-            
             irc_message = IRCMessage(message)
             
-            if (irc_message.source.nick == "PING"):
-                self.put_message("PONG " + irc_message.command)
-                irc_message.command = "PING"
+            if irc_message.command == "PING":
+                self.put_message("PONG :" + irc_message.params[-1])
             
             irc_messages.append(irc_message)
-            
+        
+        # Framing and parsing are timed for each read from the server, which may hold many lines
+        metrics = self.owner.metrics
+        metrics.observe("irc.parse", time.perf_counter() - started)
+        metrics.increment("irc.lines_received", len(irc_messages))
+        self.lines_received += len(irc_messages)
+        
         return irc_messages
     
     def handle_message(self, irc_message):
         self.check_callbacks(irc_message)
         
         # If the message source is a user in the channel, check if that user's hostmask is recorded
-        nick = irc_message.source.nick
         channel = irc_message.destination
         if channel in self.current_channels:
+            nick = irc_message.source.nick
             channel_users = self.current_channels[channel].users
             if (nick in channel_users) and (channel_users[nick].host is None):
                 channel_users[nick].ident = irc_message.source.ident
@@ -126,9 +254,29 @@ class IRCConnection(object):
         self.owner.handle_message(self, irc_message)
 
     def put_message(self, message_text):
-        text_to_send = message_text + "\r\n"
-        self.transport.write(text_to_send.encode())
-        self.log_message("put_message: " + message_text)
+        self.send_queue.put(message_text)
+        self.logger.debug("put_message: %s", message_text)
+    
+    # Join several channels with as few JOIN lines as possible
+    def join_channels(self, channel_names):
+        join_line = ""
+        
+        for channel_name in channel_names:
+            if channel_name in self.current_channels:
+                continue
+            
+            self.current_channels[channel_name] = IRCChannel(channel_name)
+            
+            if join_line == "":
+                join_line = "JOIN " + channel_name
+            elif len(join_line) + 1 + len(channel_name.encode()) <= IRCConnection.MAX_JOIN_LENGTH:
+                join_line += "," + channel_name
+            else:
+                self.put_message(join_line)
+                join_line = "JOIN " + channel_name
+        
+        if join_line != "":
+            self.put_message(join_line)
     
     def join_channel(self, channel_name):
         if channel_name not in self.current_channels:
@@ -141,20 +289,47 @@ class IRCConnection(object):
             self.put_message("PART " + channel_name)
     
     def send_message(self, destination, message_text, is_ctcp=False):
-        message = IRCMessage(message_text, is_ctcp)
-        self.put_message("PRIVMSG " + destination + " :" + message.message_text)
+        if is_ctcp:
+            message_text = IRCMessage.ctcp_quote(message_text)
+        
+        self.put_message("PRIVMSG " + destination + " :" + message_text)
     
     def send_action(self, destination, message_text):
-        message = IRCMessage("ACTION " + message_text, True)
-        self.put_message("PRIVMSG " + destination + " :" + message.message_text)
+        self.put_message("PRIVMSG " + destination + " :" + IRCMessage.ctcp_quote("ACTION " + message_text))
     
     def send_notice(self, destination, message_text, is_ctcp=False):
-        message = IRCMessage(message_text, is_ctcp)
-        self.put_message("NOTICE " + destination + " :" + message.message_text)
+        if is_ctcp:
+            message_text = IRCMessage.ctcp_quote(message_text)
+        
+        self.put_message("NOTICE " + destination + " :" + message_text)
     
+    # Returns a future for the IRCUser the server describes, or None if it has no such nick; if a WHOIS for the nick
+    # is already waiting for a reply, the future waits for that one instead of sending another
     def send_whois(self, nick):
-        self.waiting_for_whois[nick] = 0
-        self.put_message("WHOIS " + nick)
+        futures = self.waiting_for_whois.setdefault(nick, list())
+        if len(futures) == 0:
+            self.put_message("WHOIS " + nick)
+        
+        future = self.loop.create_future()
+        futures.append(future)
+        
+        return future
+    
+    # Returns the IRCUser from a WHOIS, or None if the nick doesn't exist or the server doesn't answer within timeout seconds
+    async def whois(self, nick, timeout=WHOIS_TIMEOUT):
+        future = self.send_whois(nick)
+        
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            # Whether it timed out or the caller was cancelled, the future is no longer waited for
+            futures = self.waiting_for_whois.get(nick)
+            if (futures is not None) and (future in futures):
+                futures.remove(future)
+                if len(futures) == 0:
+                    del self.waiting_for_whois[nick]
     
     def add_callback(self, command, method):
         self.callbacks[command] = method
@@ -168,6 +343,11 @@ class IRCConnection(object):
             callback = self.callbacks[irc_message.command]
             callback.method(self, irc_message, callback.arguments)
     
+    # Registration is complete, so the backoff starts over the next time the connection drops
+    @staticmethod
+    def irc_callback_welcome(irc_connection, irc_message, arguments):
+        irc_connection.failed_attempts = 0
+    
     @staticmethod
     def irc_callback_user_join(irc_connection, irc_message, arguments):
         irc_user = IRCUser(irc_message.source.nick, irc_message.source.ident, irc_message.source.host)
@@ -188,17 +368,17 @@ class IRCConnection(object):
         new_nick = irc_message.destination
         
         if irc_message.source.nick == irc_connection.nick:
-            irc_connection.nick = new_nick.lstrip(":")
+            irc_connection.nick = new_nick
+            irc_connection.owner.on_nick_change(irc_connection)
         
         for channel in irc_connection.current_channels.values():
             channel.change_nick(irc_message.source.nick, new_nick)
     
     @staticmethod
     def irc_callback_mode_change(irc_connection, irc_message, arguments):
-        mode_nicks = irc_message.rest.split(" ")
-        
-        # Get the mode string and remove it from the nick array
-        mode_string = mode_nicks.pop(0)
+        # Parameters are the channel, the mode string, then one nick for each v or o in the mode string
+        mode_string = irc_message.params[1]
+        mode_nicks = irc_message.params[2:]
         
         plus_mode = False
         for mode_char in mode_string:
@@ -221,8 +401,9 @@ class IRCConnection(object):
     
     @staticmethod
     def irc_callback_channel_users(irc_connection, irc_message, arguments):
-        users_list = irc_message.rest.lstrip(" =@*").split(" ")
-        channel = users_list.pop(0)
+        # Parameters are the bot's nick, the channel type (=, * or @, omitted by some servers), the channel, then the nicks
+        channel = irc_message.params[-2]
+        users_list = irc_message.params[-1].split(" ")
         
         for nick in users_list:
             if len(nick) > 0:
@@ -252,9 +433,10 @@ class IRCConnection(object):
     
     @staticmethod
     def irc_callback_whois_user(irc_connection, irc_message, arguments):
-        whois_data = irc_message.rest.split(" ")
+        # Parameters are the bot's nick, then the nick, ident, host, "*" and real name of the user
+        whois_data = irc_message.params[1:]
         nick = whois_data[0]
-        irc_connection.log_message("Setting host for %s" % (nick))
+        irc_connection.log_message("Setting host for %s", nick)
         
         if nick not in irc_connection.users:
             irc_user = IRCUser(nick, None, None)
@@ -268,7 +450,7 @@ class IRCConnection(object):
         """
         for channel in irc_connection.current_channels.values():
             if nick in channel.users:
-                irc_connection.log_message("Setting host for %s in channel %s" % (nick, channel.name))
+                irc_connection.log_message("Setting host for %s in channel %s", nick, channel.name)
                 irc_user = channel.users[nick]
                 irc_user.ident = whois_data[1]
                 irc_user.host = whois_data[2]
@@ -278,49 +460,90 @@ class IRCConnection(object):
     
     @staticmethod
     def irc_callback_whois_server(irc_connection, irc_message, arguments):
-        whois_data = irc_message.rest.split(" ")
+        whois_data = irc_message.params[1:]
         server = whois_data[1]
         server_info = whois_data[2]
     
     @staticmethod
     def irc_callback_whois_operator(irc_connection, irc_message, arguments):
-        whois_data = irc_message.rest.split(" ")
+        whois_data = irc_message.params[1:]
         is_oper = True
     
     @staticmethod
     def irc_callback_whois_idle(irc_connection, irc_message, arguments):
-        whois_data = irc_message.rest.split(" ")
+        whois_data = irc_message.params[1:]
         idle_time = whois_data[1]
     
     @staticmethod
     def irc_callback_whois_channels(irc_connection, irc_message, arguments):
-        whois_data = irc_message.rest.split(" ")
-        # Remove user's nick from the channel list
-        whois_data.pop(0)
-        channels = list()
-        for channel in whois_data:
-            channels.append(channel.lstrip(":"))
+        channels = irc_message.params[-1].split(" ")
     
     @staticmethod
     def irc_callback_whois_end(irc_connection, irc_message, arguments):
-        whois_data = irc_message.rest.split(" ")
-        nick = whois_data[0]
-        irc_connection.log_message("whois end " + nick)
+        nick = irc_message.params[1]
+        irc_connection.log_message("whois end %s", nick)
         
         if nick in irc_connection.waiting_for_whois:
-            del irc_connection.waiting_for_whois[nick]
-            irc_connection.log_message("deleted whois end " + nick)
+            for future in irc_connection.waiting_for_whois.pop(nick):
+                if not future.done():
+                    future.set_result(irc_connection.users.get(nick))
+            
+            irc_connection.log_message("deleted whois end %s", nick)
+        
+    #####
+    # Keepalive
+    #####
+    
+    def schedule_keepalive(self, delay):
+        if self.keepalive_handle is not None:
+            self.keepalive_handle.cancel()
+        
+        self.keepalive_handle = self.loop.call_later(delay, self.check_keepalive)
+    
+    def check_keepalive(self):
+        self.keepalive_handle = None
+        
+        if self.transport is None:
+            return
+        
+        # If the server has sent something recently, check again once it's been quiet for the whole interval
+        idle_time = self.loop.time() - self.last_activity
+        if idle_time < self.keepalive_interval:
+            self.schedule_keepalive(self.keepalive_interval - idle_time)
+            return
+        
+        self.send_ping()
+    
+    def send_ping(self):
+        self.ping_count += 1
+        self.ping_token = "fastorbot-%d" % (self.ping_count)
+        self.ping_sent_time = self.loop.time()
+        self.put_message("PING :" + self.ping_token)
+        
+        self.keepalive_handle = self.loop.call_later(self.keepalive_timeout, self.on_ping_timeout)
+    
+    def on_ping_timeout(self):
+        self.keepalive_handle = None
+        
+        self.log_message("No PONG from %s after %d seconds, reconnecting", self.hostname, self.keepalive_timeout)
+        self.reconnect()
+    
+    @staticmethod
+    def irc_callback_pong(irc_connection, irc_message, arguments):
+        if (irc_connection.ping_token is None) or (irc_message.params[-1] != irc_connection.ping_token):
+            return
+        
+        irc_connection.lag = irc_connection.loop.time() - irc_connection.ping_sent_time
+        irc_connection.lag_histogram.observe(irc_connection.lag)
         
-    def check_connection_timeout(self):
-        last_activity_delta = datetime.datetime.now() - self.last_activity
-        if last_activity_delta.seconds > 600:
-            print("Timed out")
-            self.reconnect()
+        irc_connection.ping_token = None
+        irc_connection.ping_sent_time = None
         
-        self.loop.call_later(60, self.check_connection_timeout)
+        irc_connection.schedule_keepalive(irc_connection.keepalive_interval)
     
-    def log_message(self, message_text):
-        logging.getLogger('fastorbot').info(message_text)
+    # Arguments are formatted into the message only if the record is going to be written
+    def log_message(self, message_text, *args):
+        self.logger.info(message_text, *args)
     
     def __del__(self):
         self.disconnect()
@@ -0,0 +1,83 @@
+import logging
+
+class IRCLineFramer(object):
+    # 512 bytes for the message itself plus up to 8191 bytes of IRCv3 message tags
+    MAX_LINE_LENGTH = 8703
+    
+    def __init__(self, max_line_length=MAX_LINE_LENGTH):
+        self.max_line_length = max_line_length
+        
+        self.buffer = bytearray()
+        
+        # Everything in the buffer before this position has already been searched for a line ending
+        self.scan_position = 0
+        
+        # Set while skipping the rest of a line that was too long
+        self.discarding = False
+    
+    # Add data received from the server, returning the complete lines it finished
+    # Lines may end with CRLF or a bare LF; only complete lines are decoded,
+    # so a UTF-8 character split across two reads is decoded whole
+    def feed(self, data):
+        self.buffer += data
+        
+        # Only the newly received bytes can contain the end of the current line
+        last_line_end = self.buffer.rfind(b"\n", self.scan_position)
+        if last_line_end == -1:
+            self.scan_position = len(self.buffer)
+            self.check_partial_line()
+            return list()
+        
+        # Split all the complete lines in one step and drop them from the buffer at once
+        complete = self.buffer[:last_line_end]
+        del self.buffer[:last_line_end + 1]
+        self.scan_position = len(self.buffer)
+        
+        # Decoding the whole block once is much cheaper than decoding each line; a newline byte
+        # can't be part of a multi-byte UTF-8 character, so splitting afterwards gives the same lines
+        text = complete.decode(errors="replace")
+        lines = text.split("\r\n")
+        
+        # Bare LF line endings are rare, so only split on them if there are more LFs than CRLFs
+        if text.count("\n") >= len(lines):
+            lines = [line[:-1] if line.endswith("\r") else line for line in text.split("\n")]
+        elif lines[-1].endswith("\r"):
+            # The CR of the last line's CRLF was left in the block when the LF was cut off
+            lines[-1] = lines[-1][:-1]
+        
+        # The first line is the end of a line that was too long
+        if self.discarding:
+            self.discarding = False
+            lines.pop(0)
+        
+        # The limit is in bytes; only lines that could be over it need to be re-encoded to check
+        if (len(complete) > self.max_line_length) and (max(map(len, lines)) * 4 > self.max_line_length):
+            lines = [line for line in lines if not self.is_too_long(line)]
+        
+        if "" in lines:
+            lines = [line for line in lines if line != ""]
+        
+        self.check_partial_line()
+        
+        return lines
+    
+    def is_too_long(self, line):
+        line_length = len(line.encode())
+        if line_length <= self.max_line_length:
+            return False
+        
+        logging.getLogger('fastorbot').warning("Discarding line of %d bytes from the server", line_length)
+        return True
+    
+    # A partial line that's already too long will never be accepted, so stop buffering it
+    def check_partial_line(self):
+        if len(self.buffer) > self.max_line_length + 1:
+            logging.getLogger('fastorbot').warning("Discarding line of more than %d bytes from the server", self.max_line_length)
+            self.buffer.clear()
+            self.scan_position = 0
+            self.discarding = True
+    
+    def reset(self):
+        self.buffer.clear()
+        self.scan_position = 0
+        self.discarding = False
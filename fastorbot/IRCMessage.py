@@ -3,64 +3,165 @@ import logging
 from fastorbot.IRCUser import *
 
 class IRCMessage(object):
+    # Messages are created for every line from the server, so avoid a per-instance dict
+    __slots__ = ("message_text", "tags_text", "prefix", "command", "params", "_tags", "_source")
     
-    def __init__(self, message_text, is_ctcp=False):
+    # Escape sequences allowed in IRCv3 message tag values
+    TAG_VALUE_ESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+    
+    # Parses a line of the form [@tags] [:prefix] command [params] [:trailing] in a single pass
+    def __init__(self, message_text):
         self.message_text = message_text
-        if is_ctcp:
-            self.ctcp_quote()
+        self._tags = None
+        self._source = None
         
-        message_parts = self.message_text.split(" ", 3)
+        line = message_text
         
-        self.source = IRCUser.from_userinfo(message_parts[0])
-        if len(message_parts) == 4:
-            self.rest = message_parts[3].lstrip(":")
-            if (len(self.rest) > 0) and (self.rest[0] == chr(1)):
-                self.is_ctcp = True
-                self.rest = self.rest[1:len(self.rest) - 2]
-            
-            self.destination = message_parts[2].lstrip(":")
-            self.command = message_parts[1]
-        elif len(message_parts) == 3:
-            self.rest = ""
-            self.destination = message_parts[2].lstrip(":")
-            self.command = message_parts[1]
-        elif len(message_parts) == 2:
-            self.rest = ""
-            self.destination = ""
-            self.command = message_parts[1]
+        # The tags are only split into a dict if they're used
+        if line.startswith("@"):
+            (tags_text, space, line) = line.partition(" ")
+            self.tags_text = tags_text[1:]
+            line = line.lstrip(" ")
+        else:
+            self.tags_text = None
+        
+        if line.startswith(":"):
+            (prefix, space, line) = line.partition(" ")
+            self.prefix = prefix[1:]
+            line = line.lstrip(" ")
+        else:
+            self.prefix = ""
+        
+        # Everything after the first " :" is a single trailing parameter that may contain spaces
+        (middle, trailing_separator, trailing) = line.partition(" :")
+        
+        params = middle.split(" ")
+        if "" in params:
+            params = [param for param in params if param != ""]
+        
+        if len(params) > 0:
+            self.command = params.pop(0)
         else:
-            self.rest = ""
-            self.destination = ""
             self.command = ""
         
-        # Determine where responses should be sent (e.g. if the message was sent to a channel or to the bot in a private message)
-        if self.destination.startswith("#"):
-            self.response_destination = self.destination
+        if trailing_separator:
+            params.append(trailing)
+        
+        self.params = params
+    
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = IRCMessage.parse_tags(self.tags_text)
+        
+        return self._tags
+    
+    # The user (or server) that sent the message
+    @property
+    def source(self):
+        if self._source is None:
+            self._source = IRCUser.from_userinfo(self.prefix)
+        
+        return self._source
+    
+    # The first parameter, e.g. the channel or nick a PRIVMSG was sent to
+    @property
+    def destination(self):
+        if len(self.params) > 0:
+            return self.params[0]
         else:
-            self.response_destination = self.source.nick
-
-    def ctcp_quote(self):
-        self.message_text = self.message_text.replace(chr(16), chr(16) + chr(16))
-        self.message_text = self.message_text.replace("\r", chr(16) + "r")
-        self.message_text = self.message_text.replace("\n", chr(16) + "n")
-        self.message_text = self.message_text.replace(chr(0), chr(16) + "0")
-        self.message_text = self.message_text.replace("\\", "\\\\")
-        self.message_text = self.message_text.replace(chr(1), "\\a")
-        self.message_text = chr(1) + self.message_text + chr(1)
-
-    def ctcp_unquote(self):
-        self.message_text = self.message_text[1:-2]
-        self.message_text = self.message_text.replace("\\a", chr(1))
-        self.message_text = self.message_text.replace("\\\\", "\\")
-        self.message_text = self.message_text.replace(chr(16) + "0", chr(0))
-        self.message_text = self.message_text.replace(chr(16) + "n", "\n")
-        self.message_text = self.message_text.replace(chr(16) + "r", "\r")
-        self.message_text = self.message_text.replace(chr(16) + chr(16), chr(16))
+            return ""
+    
+    # The parameters after the destination, e.g. the text of a PRIVMSG, with CTCP delimiters removed
+    @property
+    def rest(self):
+        if len(self.params) == 2:
+            rest = self.params[1]
+        else:
+            rest = " ".join(self.params[1:])
+        
+        if rest.startswith(chr(1)):
+            if rest.endswith(chr(1)):
+                rest = rest[1:-1]
+            else:
+                rest = rest[1:]
+        
+        return rest
+    
+    @property
+    def is_ctcp(self):
+        return (len(self.params) > 1) and self.params[-1].startswith(chr(1))
+    
+    # Determine where responses should be sent (e.g. if the message was sent to a channel or to the bot in a private message)
+    @property
+    def response_destination(self):
+        if (len(self.params) > 0) and self.params[0].startswith("#"):
+            return self.params[0]
+        else:
+            return self.source.nick
+    
+    @staticmethod
+    def parse_tags(tags_text):
+        tags = dict()
+        if not tags_text:
+            return tags
+        
+        for tag in tags_text.split(";"):
+            if tag == "":
+                continue
+            
+            (key, equals, value) = tag.partition("=")
+            if "\\" in value:
+                value = IRCMessage.unescape_tag_value(value)
+            
+            tags[key] = value
+        
+        return tags
+    
+    @staticmethod
+    def unescape_tag_value(value):
+        unescaped = list()
+        
+        position = 0
+        while position < len(value):
+            char = value[position]
+            if char == "\\":
+                position += 1
+                # An unknown escape is the character itself, and a trailing backslash is dropped
+                if position < len(value):
+                    unescaped.append(IRCMessage.TAG_VALUE_ESCAPES.get(value[position], value[position]))
+            else:
+                unescaped.append(char)
+            
+            position += 1
+        
+        return "".join(unescaped)
+    
+    @staticmethod
+    def ctcp_quote(message_text):
+        message_text = message_text.replace(chr(16), chr(16) + chr(16))
+        message_text = message_text.replace("\r", chr(16) + "r")
+        message_text = message_text.replace("\n", chr(16) + "n")
+        message_text = message_text.replace(chr(0), chr(16) + "0")
+        message_text = message_text.replace("\\", "\\\\")
+        message_text = message_text.replace(chr(1), "\\a")
+        return chr(1) + message_text + chr(1)
+    
+    @staticmethod
+    def ctcp_unquote(message_text):
+        message_text = message_text[1:-1]
+        message_text = message_text.replace("\\a", chr(1))
+        message_text = message_text.replace("\\\\", "\\")
+        message_text = message_text.replace(chr(16) + "0", chr(0))
+        message_text = message_text.replace(chr(16) + "n", "\n")
+        message_text = message_text.replace(chr(16) + "r", "\r")
+        message_text = message_text.replace(chr(16) + chr(16), chr(16))
+        return message_text
     
     def __str__(self):
-        return "IRCMessage: {{source: \"{source}\", command: \"{command}\", destination: \"{destination}\", rest: \"{rest}\"}}".format(
-            source=self.source,
+        return "IRCMessage: {{tags: \"{tags}\", prefix: \"{prefix}\", command: \"{command}\", params: {params}}}".format(
+            tags=self.tags_text,
+            prefix=self.prefix,
             command=self.command,
-            destination=self.destination,
-            rest=self.rest
+            params=self.params
         )
@@ -1,19 +1,9 @@
 import asyncio
-import logging
 
 class IRCProtocol(asyncio.Protocol):
     def __init__(self, loop, owner):
         self.loop = loop
         self.owner = owner
-        
-        asynciologger = logging.getLogger('fastorbot')
-        asynciologger.setLevel(logging.DEBUG)
-
-        fh = logging.FileHandler("fastorbot.log")
-        fh.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        fh.setFormatter(formatter)
-        asynciologger.addHandler(fh)
     
     def connection_made(self, transport):
         self.owner.on_connect(transport)
@@ -21,6 +11,13 @@ class IRCProtocol(asyncio.Protocol):
     def data_received(self, data):
         self.owner.on_receive(data)
 
+    # Called by the transport when its write buffer goes over or back under the high-water mark
+    def pause_writing(self):
+        self.owner.on_pause_writing()
+    
+    def resume_writing(self):
+        self.owner.on_resume_writing()
+    
     def connection_lost(self, exc):
         print('The server closed the connection')
         self.owner.on_disconnect(exc)
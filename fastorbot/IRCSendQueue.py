@@ -0,0 +1,174 @@
+import collections
+import logging
+
+from fastorbot.MetricsRegistry import *
+
+class IRCSendQueue(object):
+    # Lines that are sent ahead of everything else; the bot's own PINGs measure lag, so they shouldn't wait behind other lines
+    URGENT_COMMANDS = ("PING", "PONG", "QUIT")
+    
+    # Servers keep a clock for each client that each line moves forward by line_penalty seconds plus one second
+    # for every penalty_bytes bytes, and start dropping or killing the client once that clock is more than
+    # window seconds ahead of real time; the defaults match ircu's rules, which are the strictest in common use
+    # metrics optionally records the number of lines waiting each time one is queued, as "irc.send_queue_depth"
+    def __init__(self, window=10, line_penalty=2, penalty_bytes=120, metrics=None):
+        self.window = window
+        self.line_penalty = line_penalty
+        self.penalty_bytes = penalty_bytes
+        
+        self.loop = None
+        self.transport = None
+        self.paused = False
+        
+        # Seconds of sending that can be done right now; refills at one per second, up to the window
+        self.tokens = window
+        self.last_refill = 0
+        
+        self.urgent_lines = collections.deque()
+        
+        # Target -> deque of lines, in the order targets get their next turn
+        self.target_queues = collections.OrderedDict()
+        
+        self.flush_handle = None
+        self.flush_scheduled = False
+        
+        # Number of lines waiting to be sent, and written since the bot started
+        self.depth = 0
+        self.lines_sent = 0
+        
+        self.metrics = metrics
+    
+    def start(self, loop, transport):
+        self.loop = loop
+        self.transport = transport
+        self.paused = False
+        
+        self.tokens = self.window
+        self.last_refill = loop.time()
+        
+        # Anything queued for a previous connection no longer applies
+        self.clear()
+    
+    def stop(self):
+        self.transport = None
+        self.clear()
+    
+    def clear(self):
+        self.urgent_lines.clear()
+        self.target_queues.clear()
+        self.depth = 0
+        
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        
+        self.flush_scheduled = False
+    
+    # Queue a line to be sent; lines put during the same loop tick are written together
+    def put(self, message_text):
+        (command, space, rest) = message_text.partition(" ")
+        line = (message_text + "\r\n").encode()
+        
+        if command in IRCSendQueue.URGENT_COMMANDS:
+            self.urgent_lines.append(line)
+        else:
+            target = IRCSendQueue.get_target(command, rest)
+            if target not in self.target_queues:
+                self.target_queues[target] = collections.deque()
+            
+            self.target_queues[target].append(line)
+        
+        self.depth += 1
+        if self.metrics is not None:
+            self.metrics.observe("irc.send_queue_depth", self.depth, MetricsRegistry.SIZE_BUCKETS)
+        
+        self.schedule_flush()
+    
+    # Messages are queued fairly between the channels and nicks they're sent to; everything else shares the server's queue
+    @staticmethod
+    def get_target(command, rest):
+        if command in ("PRIVMSG", "NOTICE"):
+            return rest.partition(" ")[0]
+        else:
+            return ""
+    
+    def schedule_flush(self):
+        if self.flush_scheduled or (self.loop is None):
+            return
+        
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        
+        self.flush_scheduled = True
+        self.flush_handle = self.loop.call_soon(self.flush)
+    
+    def line_cost(self, line):
+        cost = self.line_penalty
+        if self.penalty_bytes > 0:
+            cost += len(line) / self.penalty_bytes
+        
+        # A line that costs more than the whole window can still be sent once the window is full
+        return min(cost, self.window)
+    
+    def flush(self):
+        self.flush_scheduled = False
+        self.flush_handle = None
+        
+        if self.transport is None:
+            return
+        
+        now = self.loop.time()
+        self.tokens = min(self.window, self.tokens + now - self.last_refill)
+        self.last_refill = now
+        
+        lines = list()
+        
+        # Urgent lines don't wait for the bucket, but still count against it
+        while len(self.urgent_lines) > 0:
+            line = self.urgent_lines.popleft()
+            self.tokens -= self.line_cost(line)
+            lines.append(line)
+        
+        # While the transport's buffer is full, only urgent lines are written
+        if not self.paused:
+            # Take one line from each target in turn, so one busy channel can't hold up the others
+            while len(self.target_queues) > 0:
+                (target, target_queue) = next(iter(self.target_queues.items()))
+                
+                cost = self.line_cost(target_queue[0])
+                if cost > self.tokens:
+                    break
+                
+                self.tokens -= cost
+                lines.append(target_queue.popleft())
+                
+                if len(target_queue) > 0:
+                    self.target_queues.move_to_end(target)
+                else:
+                    del self.target_queues[target]
+        
+        if len(lines) > 0:
+            self.depth -= len(lines)
+            self.lines_sent += len(lines)
+            self.transport.write(b"".join(lines))
+        
+        # Wait until there's enough in the bucket for the next line
+        if (len(self.target_queues) > 0) and not self.paused:
+            target_queue = next(iter(self.target_queues.values()))
+            delay = self.line_cost(target_queue[0]) - self.tokens
+            self.flush_handle = self.loop.call_later(delay, self.flush)
+    
+    def pause_writing(self):
+        logging.getLogger('fastorbot').info("Send buffer is full, pausing the send queue")
+        self.paused = True
+        
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+    
+    def resume_writing(self):
+        logging.getLogger('fastorbot').info("Send buffer has drained, resuming the send queue")
+        self.paused = False
+        self.schedule_flush()
+
@@ -0,0 +1,41 @@
+import heapq
+import time
+
+class IgnoreList(object):
+    # Latest end time that fits in an SQLite integer column, used for ignores that should never end
+    MAX_ENDTIME = 2**63 - 1
+    
+    def __init__(self):
+        # Host -> end time (Unix timestamp) of the longest active ignore for that host
+        self.ignored_hosts = dict()
+        
+        # Min-heap of (end time, host), used to evict ignores once they expire
+        self.expiry_heap = list()
+    
+    def add(self, host, endtime):
+        if endtime <= self.ignored_hosts.get(host, 0):
+            return
+        
+        self.ignored_hosts[host] = endtime
+        heapq.heappush(self.expiry_heap, (endtime, host))
+    
+    # The host's entries in the heap are left behind and discarded when they reach the top
+    def remove(self, host):
+        if host in self.ignored_hosts:
+            del self.ignored_hosts[host]
+    
+    def is_ignored(self, host):
+        if host not in self.ignored_hosts:
+            return False
+        
+        self.expire(time.time())
+        
+        return host in self.ignored_hosts
+    
+    def expire(self, now):
+        while (len(self.expiry_heap) > 0) and (self.expiry_heap[0][0] <= now):
+            (endtime, host) = heapq.heappop(self.expiry_heap)
+            
+            # Only evict the host if this entry is still its current end time
+            if self.ignored_hosts.get(host) == endtime:
+                del self.ignored_hosts[host]
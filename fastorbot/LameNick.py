@@ -0,0 +1,128 @@
+import functools
+import math
+import re
+
+class LameNick(object):
+    # Points for each (non-overlapping) match of a pattern anywhere in the nick
+    SPECIAL_COSTS = [
+        ("69", 2000),
+        ("dea?th", 500),
+        ("dark", 500),
+        ("n[i1]ght", 500),
+        ("n[i1]te", 750),
+        ("fuck", 5000),
+        ("sh[i1]t", 5000),
+        ("coo[l1]", 1000),
+        ("kew[l1]", 1000),
+        ("lame", 500),
+        ("d(oo)|(00)d", 1500),
+        ("dude", 1000),
+        ("rool[sz]", 1500),
+        ("rule[sz]", 1000),
+        ("[l1](oo?|u)[sz]er", 1000),
+        ("[l1]eet", 1500),
+        ("e[l1]ite", 750),
+        ("[l1]ord", 500),
+        ("k[i1]ng", 500),
+        ("pron", 2000),
+        ("warez", 2500),
+        ("xx", 250),
+        ("[rkx]0", 500),
+        ("0[rkx]", 500),
+        ("[Cc][Hh][Oo][Bb][Oo]", 10**20)
+    ]
+    
+    # Every character a match of one of the patterns can start with; other positions are skipped without trying each pattern
+    SPECIAL_FIRST_CHARACTERS = "06Ccdefklnprswx1"
+    
+    # One lookahead per position finds where each pattern matches; no two patterns can match at the same position, so
+    # the first alternative to match is the only one. A new pattern must keep that true, and add its first characters
+    # to SPECIAL_FIRST_CHARACTERS, or matches will be missed
+    SPECIAL_PATTERN = re.compile("(?=[" + SPECIAL_FIRST_CHARACTERS + "])(?=" + "|".join("(%s)" % (re.sub(r"\((?!\?)", "(?:", pattern)) for (pattern, cost) in SPECIAL_COSTS) + ")")
+    
+    # Maps each byte of a nick to its character class: l for lowercase, U for uppercase, d for digits, b for brackets and s
+    # for any other symbol; characters outside ASCII are encoded as "?" first, so they count as symbols too
+    CLASS_TABLE = bytearray(b"s" * 256)
+    for (characters, character_class) in ((b"abcdefghijklmnopqrstuvwxyz", b"l"), (b"ABCDEFGHIJKLMNOPQRSTUVWXYZ", b"U"), (b"0123456789", b"d"), (b"()[]{}", b"b")):
+        for c in characters:
+            CLASS_TABLE[c] = character_class[0]
+    CLASS_TABLE = bytes(CLASS_TABLE)
+    del characters, character_class, c
+    
+    # Leading digits are any Unicode digits, as in the original scorer, so they're found in the nick rather than the classes
+    LEADING_DIGITS_PATTERN = re.compile(r"\d+")
+    
+    SYMBOL_RUN_PATTERN = re.compile(rb"[sb]{2,}")
+    UPPER_RUN_PATTERN = re.compile(rb"U{2,}")
+    
+    # Scores are remembered for the last cache_size nicks, since the same nicks tend to be asked about again
+    def __init__(self, cache_size=1024):
+        self.get_score = functools.lru_cache(maxsize=cache_size)(self.calculate_score)
+    
+    # Returns a tuple (lameness points, lameness rating as a percentage)
+    # Points are added up in the same order as the original scorer, since floating point sums depend on the order
+    def calculate_score(self, nick):
+        lameness_points = 0
+        
+        # Each pattern's matches are counted separately, skipping matches that overlap an earlier one of the same pattern
+        match_ends = [0] * len(LameNick.SPECIAL_COSTS)
+        match_counts = [0] * len(LameNick.SPECIAL_COSTS)
+        
+        for match in LameNick.SPECIAL_PATTERN.finditer(nick):
+            pattern_number = match.lastindex - 1
+            if match.start() >= match_ends[pattern_number]:
+                match_ends[pattern_number] = match.end(match.lastindex)
+                match_counts[pattern_number] += 1
+        
+        for (pattern_number, (pattern, cost)) in enumerate(LameNick.SPECIAL_COSTS):
+            lameness_points += match_counts[pattern_number] * cost
+        
+        # Everything else depends only on the class of each character, where digits are only 0-9
+        classes = nick.encode("ascii", "replace").translate(LameNick.CLASS_TABLE)
+        
+        # Punish consecutive non-alphas
+        for match in LameNick.SYMBOL_RUN_PATTERN.findall(classes):
+            lameness_points += 100 * 2**len(match)
+        
+        # Starts with one or more digits
+        match = LameNick.LEADING_DIGITS_PATTERN.match(nick)
+        if match is not None:
+            lameness_points += 100 * 1.2**len(match.group(0))
+        
+        # Starts with non-alphanumeric
+        leading_symbols = len(classes) - len(classes.lstrip(b"sb"))
+        if leading_symbols > 0:
+            lameness_points += 500 * 1.5**leading_symbols
+        
+        # Ends with non-alphanumeric
+        trailing_symbols = len(classes) - len(classes.rstrip(b"sb"))
+        if trailing_symbols > 0:
+            lameness_points += 250 * 1.3**trailing_symbols
+        
+        # Changes in character type; a pair of characters from two different classes can't overlap the next such pair of
+        # the same two classes, so counting pairs gives the same numbers as finding them one after another
+        num_case_shifts = classes.count(b"lU") + classes.count(b"Ul")
+        if num_case_shifts > 1:
+            lameness_points += 50 * 1.2**num_case_shifts
+        
+        num_alnum_shifts = classes.count(b"ld") + classes.count(b"Ud") + classes.count(b"dl") + classes.count(b"dU")
+        if num_alnum_shifts > 0:
+            lameness_points += 100 * 1.2**num_alnum_shifts
+        
+        symbol_classes = classes.replace(b"b", b"s")
+        num_symbol_shifts = symbol_classes.count(b"ls") + symbol_classes.count(b"Us") + symbol_classes.count(b"ds")
+        num_symbol_shifts += symbol_classes.count(b"sl") + symbol_classes.count(b"sU") + symbol_classes.count(b"sd")
+        if num_symbol_shifts > 0:
+            lameness_points += 250 * 1.8**num_symbol_shifts
+        
+        for match in LameNick.UPPER_RUN_PATTERN.findall(classes):
+            lameness_points += 100 * 1.3**len(match)
+        
+        # Symbols other than brackets
+        num_symbols = classes.count(b"s")
+        if num_symbols > 0:
+            lameness_points += 250 * 1.8**num_symbols
+        
+        lameness_score = round(6400 * (math.atan(lameness_points / 1000) / math.pi)**6, 2)
+        
+        return (round(lameness_points), lameness_score)
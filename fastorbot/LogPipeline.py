@@ -0,0 +1,71 @@
+import logging
+import logging.handlers
+import queue
+
+class LogPipeline(object):
+    FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    
+    # Sends the bot's log records through a queue to one rotating file handler on a background thread,
+    # so the event loop never waits on the disk
+    def __init__(self, filename="fastorbot.log", level=logging.DEBUG, max_bytes=10485760, backup_count=5):
+        self.filename = filename
+        self.level = level
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        
+        self.queue_handler = None
+        self.listener = None
+    
+    # Attaches the pipeline to the bot's logger, and to asyncio's so errors in tasks and callbacks end up in the same file;
+    # any handlers they already have are replaced, so calling it again doesn't write each record twice
+    def start(self):
+        file_handler = logging.handlers.RotatingFileHandler(self.filename, maxBytes=self.max_bytes, backupCount=self.backup_count, encoding="utf-8")
+        file_handler.setFormatter(logging.Formatter(LogPipeline.FORMAT))
+        
+        self.queue_handler = DeferredQueueHandler(queue.SimpleQueue())
+        
+        logging.getLogger("fastorbot").setLevel(self.level)
+        
+        for logger_name in ("fastorbot", "asyncio"):
+            logger = logging.getLogger(logger_name)
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+            
+            logger.addHandler(self.queue_handler)
+        
+        self.listener = logging.handlers.QueueListener(self.queue_handler.queue, file_handler)
+        self.listener.start()
+    
+    # Writes out everything still queued and closes the file
+    def stop(self):
+        if self.listener is None:
+            return
+        
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+        
+        self.listener = None
+    
+    @staticmethod
+    def get_level(level_name):
+        level = logging.getLevelName(level_name.upper())
+        if not isinstance(level, int):
+            raise EnvironmentError("Unknown log level " + level_name)
+        
+        return level
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler runs the whole formatter, timestamp and all, before queueing each record; here only the message
+    # and any traceback are rendered up front, while they still hold the values they had when the message was logged,
+    # and the rest of the formatting is left to the listener thread
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        
+        return record
@@ -0,0 +1,127 @@
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+class LoopWatchdog(object):
+    # Most stack frames included in a stall report, counting out from the one that was running
+    STACK_LIMIT = 20
+    
+    # A timer on the event loop records how late it runs each time; a thread watches that timer and, when it's more than
+    # threshold seconds overdue, reports what the loop thread is doing at that moment
+    # Commands run as tasks named after their metric (see Fastorbot.handle_command), so a stall inside one is reported
+    # with the command's name; anything else is named after the outermost fastorbot function on the stack
+    def __init__(self, metrics, interval=0.5, threshold=0.5):
+        self.metrics = metrics
+        self.interval = interval
+        self.threshold = threshold
+        
+        self.loop = None
+        self.loop_thread_id = None
+        self.heartbeat_handle = None
+        
+        # When the heartbeat is next due, by time.monotonic(), which the thread can read without the loop
+        self.next_due = None
+        self.reported_due = None
+        
+        # How late the most recent heartbeat ran, in seconds
+        self.loop_lag = None
+        
+        # Activities the thread found blocking the loop, for the heartbeat to record once the loop is running again
+        self.stalls = collections.deque()
+        
+        self.thread = None
+        self.stop_event = threading.Event()
+        
+        self.logger = logging.getLogger('fastorbot')
+        self.package_dir = os.path.dirname(os.path.abspath(__file__))
+    
+    # Must be called from the loop's thread
+    def start(self, loop):
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        
+        self.next_due = time.monotonic() + self.interval
+        self.heartbeat_handle = loop.call_later(self.interval, self.heartbeat)
+        
+        if self.threshold > 0:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.watch, name="fastorbot-watchdog", daemon=True)
+            self.thread.start()
+    
+    def stop(self):
+        if self.heartbeat_handle is not None:
+            self.heartbeat_handle.cancel()
+            self.heartbeat_handle = None
+        
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+    
+    #####
+    # Event loop thread
+    #####
+    
+    def heartbeat(self):
+        now = time.monotonic()
+        
+        self.loop_lag = max(0, now - self.next_due)
+        self.metrics.observe("loop.lag", self.loop_lag)
+        
+        # The loop was blocked until just now, so this is how long the stall lasted
+        while len(self.stalls) > 0:
+            activity = self.stalls.popleft()
+            self.metrics.increment("stall." + activity)
+            self.metrics.observe("loop.stall", self.loop_lag)
+            self.logger.warning("Event loop was blocked for %.3f seconds by %s", self.loop_lag, activity)
+        
+        self.next_due = now + self.interval
+        self.heartbeat_handle = self.loop.call_later(self.interval, self.heartbeat)
+    
+    #####
+    # Watchdog thread
+    #####
+    
+    def watch(self):
+        # Checking twice per threshold means a stall is reported at most one and a half thresholds after it starts
+        while not self.stop_event.wait(self.threshold / 2):
+            due = self.next_due
+            overdue = time.monotonic() - due
+            
+            # Each stall is reported once, however long it lasts
+            if (overdue > self.threshold) and (due != self.reported_due):
+                self.reported_due = due
+                self.report_stall(overdue)
+    
+    def report_stall(self, overdue):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return
+        
+        activity = self.get_activity(frame)
+        stack = "".join(traceback.format_stack(frame, LoopWatchdog.STACK_LIMIT)).rstrip("\n")
+        
+        self.logger.warning("Event loop is %.3f seconds behind, blocked by %s:\n%s", overdue, activity, stack)
+        
+        # deque appends are atomic, so the heartbeat can pick this up without a lock
+        self.stalls.append(activity)
+    
+    # Returns the name of the running task, or of the outermost function in the bot's own code
+    def get_activity(self, frame):
+        task = asyncio.current_task(self.loop)
+        if task is not None:
+            return task.get_name()
+        
+        activity = "unknown"
+        while frame is not None:
+            if frame.f_code.co_filename.startswith(self.package_dir):
+                activity = frame.f_code.co_name
+            
+            frame = frame.f_back
+        
+        return activity
@@ -0,0 +1,108 @@
+import asyncio
+import os
+import time
+
+from fastorbot.Histogram import *
+
+class MetricsRegistry(object):
+    # Upper bounds of the buckets for timings, in seconds
+    LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+    
+    # Upper bounds of the buckets for sizes, such as queue depths
+    SIZE_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+    
+    # Metrics are only updated from the event loop thread; work done on other threads is timed there and
+    # the timing is recorded once its result is back on the loop (see track_future)
+    def __init__(self):
+        self.counters = dict()
+        self.histograms = dict()
+        
+        self.started = time.time()
+    
+    def increment(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+    
+    def observe(self, name, value, bounds=LATENCY_BUCKETS):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = Histogram(bounds)
+            self.histograms[name] = histogram
+        
+        histogram.observe(value)
+    
+    # Runs a function and returns a tuple (result, seconds taken), for timing work run on an executor
+    @staticmethod
+    def timed_call(function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        return (result, time.perf_counter() - started)
+    
+    # Takes a future for the result of timed_call and returns a future for just the result, recording
+    # the time taken in the named histogram
+    # Cancelling the returned future doesn't cancel timed_future, so work already handed to an executor still runs;
+    # anything that has to know when that work is finished should wait on timed_future itself
+    def track_future(self, timed_future, name):
+        loop = asyncio.get_event_loop()
+        result_future = loop.create_future()
+        
+        def on_done(future):
+            if result_future.cancelled():
+                return
+            
+            if future.cancelled():
+                result_future.cancel()
+            elif future.exception() is not None:
+                self.increment(name + ".errors")
+                result_future.set_exception(future.exception())
+            else:
+                (result, elapsed) = future.result()
+                self.observe(name, elapsed)
+                result_future.set_result(result)
+        
+        timed_future.add_done_callback(on_done)
+        
+        return result_future
+    
+    # Returns the metrics as lines of text, one per counter and one per histogram
+    def format_lines(self, prefix=""):
+        lines = list()
+        
+        for name in sorted(self.counters):
+            if name.startswith(prefix):
+                lines.append("%s %d" % (name, self.counters[name]))
+        
+        for name in sorted(self.histograms):
+            if name.startswith(prefix):
+                lines.append(MetricsRegistry.format_histogram(name, self.histograms[name]))
+        
+        return lines
+    
+    @staticmethod
+    def format_histogram(name, histogram):
+        return "%s count=%d mean=%s p50<=%s p95<=%s p99<=%s max=%s" % (
+            name,
+            histogram.count,
+            MetricsRegistry.format_value(histogram.mean()),
+            MetricsRegistry.format_value(histogram.percentile(50)),
+            MetricsRegistry.format_value(histogram.percentile(95)),
+            MetricsRegistry.format_value(histogram.percentile(99)),
+            MetricsRegistry.format_value(histogram.max)
+        )
+    
+    @staticmethod
+    def format_value(value):
+        if value is None:
+            return "-"
+        
+        return "%.6g" % (value)
+    
+    # Writes every metric to a file, replacing it in one step so readers never see a partial dump
+    def dump(self, filename):
+        lines = ["# fastorbot metrics at %s, up %d seconds" % (time.strftime("%Y-%m-%d %H:%M:%S"), time.time() - self.started)]
+        lines.extend(self.format_lines())
+        
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "w") as dump_file:
+            dump_file.write("\n".join(lines) + "\n")
+        
+        os.replace(temp_filename, filename)
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import re
+
+class MetricsServer(object):
+    # Seconds a client has to send its request before the connection is closed
+    REQUEST_TIMEOUT = 5
+    
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+    
+    # Serves the bot's metrics over HTTP in the Prometheus text format, from the bot's own event loop
+    # It's meant to be scraped locally, so it listens on the loopback interface unless configured otherwise
+    def __init__(self, bot, host="127.0.0.1", port=9465):
+        self.bot = bot
+        self.host = host
+        self.port = port
+        
+        self.server = None
+    
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        logging.getLogger('fastorbot').info("Serving metrics on http://%s:%d/metrics", self.host, self.port)
+    
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+    
+    async def handle_client(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), MetricsServer.REQUEST_TIMEOUT)
+            
+            # Headers aren't needed, but they have to be read before responding
+            while True:
+                header_line = await asyncio.wait_for(reader.readline(), MetricsServer.REQUEST_TIMEOUT)
+                if header_line.strip() == b"":
+                    break
+            
+            request_parts = request_line.decode("latin-1").split()
+            if (len(request_parts) >= 2) and (request_parts[0] == "GET") and (request_parts[1].split("?")[0] == "/metrics"):
+                self.write_response(writer, "200 OK", self.render())
+            else:
+                self.write_response(writer, "404 Not Found", "Not found\n")
+            
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            # ValueError is raised for a line longer than the reader's limit
+            pass
+        finally:
+            writer.close()
+    
+    def write_response(self, writer, status, body):
+        body_bytes = body.encode()
+        headers = "HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % (status, MetricsServer.CONTENT_TYPE, len(body_bytes))
+        writer.write(headers.encode() + body_bytes)
+    
+    #####
+    # Text format
+    #####
+    
+    def render(self):
+        lines = list()
+        metrics = self.bot.metrics
+        
+        # Per-network traffic and connection state; rates such as messages per second are left to the scraper
+        self.add_header(lines, "fastorbot_messages_received_total", "counter", "Lines received from the IRC server")
+        self.add_header(lines, "fastorbot_messages_sent_total", "counter", "Lines sent to the IRC server")
+        self.add_header(lines, "fastorbot_reconnects_total", "counter", "Times the connection was lost and the bot reconnected")
+        self.add_header(lines, "fastorbot_send_queue_lines", "gauge", "Lines waiting in the send queue")
+        self.add_header(lines, "fastorbot_irc_lag_seconds", "gauge", "Round trip time of the last keepalive PING")
+        self.add_header(lines, "fastorbot_channels", "gauge", "Channels the bot is in")
+        self.add_header(lines, "fastorbot_channel_users", "gauge", "Users in each channel the bot is in")
+        
+        for network in self.bot.get_network_list():
+            irc_connection = network.irc_connection
+            labels = {"network": network.name}
+            
+            lines.append(self.format_sample("fastorbot_messages_received_total", labels, irc_connection.lines_received))
+            lines.append(self.format_sample("fastorbot_messages_sent_total", labels, irc_connection.send_queue.lines_sent))
+            lines.append(self.format_sample("fastorbot_reconnects_total", labels, irc_connection.reconnect_count))
+            lines.append(self.format_sample("fastorbot_send_queue_lines", labels, irc_connection.send_queue.depth))
+            if irc_connection.lag is not None:
+                lines.append(self.format_sample("fastorbot_irc_lag_seconds", labels, irc_connection.lag))
+            
+            lines.append(self.format_sample("fastorbot_channels", labels, len(irc_connection.current_channels)))
+            for channel in irc_connection.current_channels.values():
+                lines.append(self.format_sample("fastorbot_channel_users", {"network": network.name, "channel": channel.name}, len(channel.users)))
+        
+        self.add_header(lines, "fastorbot_event_loop_lag_seconds", "gauge", "How late the event loop ran the most recent lag check")
+        if self.bot.watchdog.loop_lag is not None:
+            lines.append(self.format_sample("fastorbot_event_loop_lag_seconds", None, self.bot.watchdog.loop_lag))
+        
+        factoid_cache = self.bot.factoid_cache
+        if factoid_cache is not None:
+            self.add_header(lines, "fastorbot_factoid_cache_hits_total", "counter", "Factoid lookups answered from the cache")
+            lines.append(self.format_sample("fastorbot_factoid_cache_hits_total", None, factoid_cache.hits))
+            self.add_header(lines, "fastorbot_factoid_cache_misses_total", "counter", "Factoid lookups that went to the database")
+            lines.append(self.format_sample("fastorbot_factoid_cache_misses_total", None, factoid_cache.misses))
+            self.add_header(lines, "fastorbot_factoid_cache_evictions_total", "counter", "Subjects evicted from the factoid cache")
+            lines.append(self.format_sample("fastorbot_factoid_cache_evictions_total", None, factoid_cache.evictions))
+            self.add_header(lines, "fastorbot_factoid_cache_subjects", "gauge", "Subjects in the factoid cache")
+            lines.append(self.format_sample("fastorbot_factoid_cache_subjects", None, len(factoid_cache.entries)))
+        
+        # Everything in the metrics registry; commands and database methods become labels of one metric each
+        for (name, histogram_names) in self.group_names(metrics.histograms).items():
+            self.add_header(lines, name, "histogram", None)
+            for (registry_name, labels) in histogram_names:
+                self.add_histogram(lines, name, labels, metrics.histograms[registry_name])
+        
+        for (name, counter_names) in self.group_names(metrics.counters).items():
+            self.add_header(lines, name + "_total", "counter", None)
+            for (registry_name, labels) in counter_names:
+                lines.append(self.format_sample(name + "_total", labels, metrics.counters[registry_name]))
+        
+        return "\n".join(lines) + "\n"
+    
+    # Returns a dict of metric name -> list of (registry name, labels), in registry name order
+    def group_names(self, registry):
+        groups = dict()
+        
+        for registry_name in sorted(registry):
+            (name, labels) = MetricsServer.get_metric_name(registry_name)
+            groups.setdefault(name, list()).append((registry_name, labels))
+        
+        return groups
+    
+    # Maps a registry name such as "db.fetch_factoid" to a metric name and labels
+    @staticmethod
+    def get_metric_name(registry_name):
+        parts = registry_name.split(".")
+        
+        if (parts[0] == "command") and (len(parts) >= 2):
+            if parts[-1] == "errors":
+                return ("fastorbot_command_errors", {"command": ".".join(parts[1:-1])})
+            elif parts[-1] == "timeouts":
+                return ("fastorbot_command_timeouts", {"command": ".".join(parts[1:-1])})
+            else:
+                return ("fastorbot_command_duration_seconds", {"command": ".".join(parts[1:])})
+        elif (parts[0] == "db") and (len(parts) >= 2):
+            if parts[-1] == "errors":
+                return ("fastorbot_db_query_errors", {"method": ".".join(parts[1:-1])})
+            else:
+                return ("fastorbot_db_query_duration_seconds", {"method": ".".join(parts[1:])})
+        elif (parts[0] == "stall") and (len(parts) >= 2):
+            return ("fastorbot_loop_stalls", {"activity": ".".join(parts[1:])})
+        else:
+            return ("fastorbot_" + re.sub("[^a-zA-Z0-9_]", "_", registry_name), None)
+    
+    def add_header(self, lines, name, metric_type, help_text):
+        if help_text is not None:
+            lines.append("# HELP %s %s" % (name, help_text))
+        
+        lines.append("# TYPE %s %s" % (name, metric_type))
+    
+    def add_histogram(self, lines, name, labels, histogram):
+        for (bound, count) in histogram.cumulative_counts():
+            bucket_labels = dict(labels or {})
+            if bound is None:
+                bucket_labels["le"] = "+Inf"
+            else:
+                bucket_labels["le"] = repr(float(bound))
+            
+            lines.append(self.format_sample(name + "_bucket", bucket_labels, count))
+        
+        lines.append(self.format_sample(name + "_sum", labels, histogram.sum))
+        lines.append(self.format_sample(name + "_count", labels, histogram.count))
+    
+    def format_sample(self, name, labels, value):
+        if labels:
+            label_text = ",".join("%s=\"%s\"" % (key, MetricsServer.escape_label(str(label_value))) for (key, label_value) in labels.items())
+            return "%s{%s} %s" % (name, label_text, MetricsServer.format_number(value))
+        else:
+            return "%s %s" % (name, MetricsServer.format_number(value))
+    
+    @staticmethod
+    def escape_label(value):
+        return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    
+    @staticmethod
+    def format_number(value):
+        if isinstance(value, int):
+            return str(value)
+        
+        return repr(float(value))
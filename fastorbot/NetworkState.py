@@ -0,0 +1,30 @@
+from fastorbot.ChannelFlags import *
+from fastorbot.CommandScheduler import *
+from fastorbot.HostmaskIndex import *
+
+class NetworkState(object):
+    # State the bot keeps separately for each network it's connected to
+    def __init__(self, name, server_node, irc_connection, command_scheduler=None):
+        self.name = name
+        self.server_node = server_node
+        self.irc_connection = irc_connection
+        
+        # Commands sent on this network, which are cancelled if it disconnects
+        if command_scheduler is not None:
+            self.command_scheduler = command_scheduler
+        else:
+            self.command_scheduler = CommandScheduler()
+        
+        # Destination -> last factoid sent there, for "that"
+        self.that_factoids = dict()
+        
+        # BotUsers by the hostmasks they identified from on this network, and by their wildcard masks
+        self.identified_users = HostmaskIndex()
+        
+        # Flags users have for this network's channels
+        self.channel_flags = ChannelFlags()
+        
+        self.current_poll = None
+        
+        # Built once the connection's nick is known, and again whenever it changes
+        self.command_matcher = None
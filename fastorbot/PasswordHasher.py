@@ -0,0 +1,60 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import os
+
+from fastorbot.MetricsRegistry import *
+
+class PasswordHasher(object):
+    ITERATIONS = 500000
+    
+    # metrics optionally records how long each derivation takes, as "password.derive"
+    def __init__(self, max_workers=2, max_pending=4, metrics=None):
+        # pbkdf2_hmac releases the GIL, so a thread pool is enough to keep key derivation off the event loop
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fastorbot-hasher")
+        self.max_pending = max_pending
+        self.pending = 0
+        
+        self.metrics = metrics
+    
+    # Returns a future for the list of keys derived from each password, or None if too many derivations are already waiting
+    def derive_keys(self, passwords, salt):
+        if self.pending >= self.max_pending:
+            return None
+        
+        self.pending += 1
+        
+        loop = asyncio.get_event_loop()
+        if self.metrics is not None:
+            future = loop.run_in_executor(self.executor, MetricsRegistry.timed_call, PasswordHasher.gen_user_keys, passwords, salt)
+            future = self.metrics.track_future(future, "password.derive")
+        else:
+            future = loop.run_in_executor(self.executor, PasswordHasher.gen_user_keys, passwords, salt)
+        
+        future.add_done_callback(self.on_derive_done)
+        
+        return future
+    
+    def on_derive_done(self, future):
+        self.pending -= 1
+    
+    @staticmethod
+    def gen_user_keys(passwords, salt):
+        user_keys = list()
+        
+        for password in passwords:
+            user_keys.append(PasswordHasher.gen_user_key(password, salt))
+        
+        return user_keys
+    
+    @staticmethod
+    def gen_user_key(password, salt):
+        user_key = hashlib.pbkdf2_hmac("sha512", password.encode(), bytes.fromhex(salt), PasswordHasher.ITERATIONS)
+        return user_key.hex()
+    
+    @staticmethod
+    def generate_salt():
+        return os.urandom(32).hex()
+    
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -1,32 +1,184 @@
-import hashlib
 import logging
 import os
+import random
+import re
 import sqlite3
+import urllib.parse
 
 from fastorbot.BotUser import *
 from fastorbot.Factoid import *
 
 class SQLiteDatabase(object):
-    def __init__(self, dsn):
-        self.connection = sqlite3.connect(dsn, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+    # Value of PRAGMA user_version once every migration in upgrade_schema() has been applied
+    SCHEMA_VERSION = 5
+    
+    # Number of random ids fetch_random_factoid tries before falling back to counting the table
+    RANDOM_FACTOID_PROBES = 8
+    
+    # PRAGMAs that can be set by a connection profile
+    PROFILE_PRAGMAS = ["journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store", "busy_timeout"]
+    
+    # With write_batch_size set, changes are left in an open transaction and committed together, either once
+    # write_batch_size changes are pending or when flush() is called; this connection still sees them immediately
+    # profile is a dict of PRAGMA settings applied to the connection
+    # A read_only connection is opened on the same file for queries and doesn't upgrade the schema
+    def __init__(self, dsn, write_batch_size=None, profile=None, read_only=False):
+        self.write_batch_size = write_batch_size
+        self.pending_writes = 0
+        self.read_only = read_only
+        
+        if read_only:
+            self.connection = sqlite3.connect(SQLiteDatabase.read_only_uri(dsn), uri=True, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        else:
+            self.connection = sqlite3.connect(dsn, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        
         self.connection.row_factory = sqlite3.Row
+        self.connection.create_function("subject_key", 1, SQLiteDatabase.subject_key, deterministic=True)
         self.cursor = self.connection.cursor()
+        
+        if profile is not None:
+            self.apply_profile(profile)
+        
+        if not read_only:
+            self.upgrade_schema()
+    
+    @staticmethod
+    def read_only_uri(dsn):
+        return "file:" + urllib.parse.quote(os.path.abspath(dsn)) + "?mode=ro"
+    
+    def apply_profile(self, profile):
+        for (pragma, value) in profile.items():
+            if pragma not in SQLiteDatabase.PROFILE_PRAGMAS:
+                raise EnvironmentError("Invalid database profile setting: " + pragma)
+            
+            # PRAGMA values can't be bound as parameters, so only allow plain words and numbers
+            if re.match("^-?\\w+$", str(value)) is None:
+                raise EnvironmentError("Invalid value for database profile setting {pragma}: {value}".format(pragma=pragma, value=value))
+            
+            # The journal mode is stored in the database file, so it's left to the connection that writes
+            if (pragma == "journal_mode") and self.read_only:
+                continue
+            
+            self.cursor.execute("PRAGMA {pragma} = {value}".format(pragma=pragma, value=value))
+            self.cursor.fetchall()
+    
+    # Subjects are matched case-insensitively, so lookups use a case-folded copy of the subject that can be indexed
+    @staticmethod
+    def subject_key(subject):
+        if subject is None:
+            return None
+        
+        return subject.casefold()
+    
+    def upgrade_schema(self):
+        migrations = [
+            self.migrate_subject_keys,
+            self.migrate_ignore_endtimes,
+            self.migrate_user_networks,
+            self.migrate_user_masks,
+            self.migrate_user_flag_networks
+        ]
+        
+        self.cursor.execute("PRAGMA user_version")
+        schema_version = self.cursor.fetchone()[0]
+        
+        for version in range(schema_version, SQLiteDatabase.SCHEMA_VERSION):
+            logging.getLogger('fastorbot').info("Upgrading database schema to version %d", version + 1)
+            
+            self.cursor.execute("BEGIN")
+            migrations[version]()
+            self.cursor.execute("PRAGMA user_version = %d" % (version + 1))
+            self.connection.commit()
+    
+    # Version 1: add an indexed, case-folded subject key to factoids and subjects
+    def migrate_subject_keys(self):
+        self.cursor.execute("ALTER TABLE factoids ADD COLUMN subject_key text DEFAULT '' NOT NULL")
+        self.cursor.execute("ALTER TABLE subjects ADD COLUMN subject_key text DEFAULT '' NOT NULL")
+        
+        self.cursor.execute("UPDATE factoids SET subject_key = subject_key(subject)")
+        self.cursor.execute("UPDATE subjects SET subject_key = subject_key(subject)")
+        
+        self.cursor.execute("CREATE INDEX factoids_subject_key_id ON factoids (subject_key, id)")
+        self.cursor.execute("CREATE INDEX factoids_groupid_id ON factoids (groupid, id)")
+        self.cursor.execute("CREATE INDEX subjects_subject_key ON subjects (subject_key)")
+        self.cursor.execute("CREATE INDEX denies_subject ON denies (subject)")
+    
+    # Version 2: ignore end times were stored as local time strings; store them as Unix timestamps instead
+    def migrate_ignore_endtimes(self):
+        self.cursor.execute("""
+            UPDATE
+                ignores
+            SET
+                endtime = COALESCE(CAST(strftime('%s', substr(endtime, 1, 19), 'utc') AS integer), 0)
+            WHERE
+                typeof(endtime) = 'text'
+        """)
+    
+    # Version 3: record which network each user's host was identified on
+    def migrate_user_networks(self):
+        self.cursor.execute("ALTER TABLE users ADD COLUMN network text DEFAULT '' NOT NULL")
+    
+    # Version 4: wildcard hostmasks that identify a user without the identify command
+    def migrate_user_masks(self):
+        self.cursor.execute("""
+            CREATE TABLE user_masks (
+                id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+                userid integer NOT NULL,
+                mask text NOT NULL,
+                network text DEFAULT '' NOT NULL
+            )
+        """)
+        self.cursor.execute("CREATE INDEX user_masks_userid ON user_masks (userid)")
+        self.cursor.execute("CREATE UNIQUE INDEX user_masks_network_mask ON user_masks (network, mask)")
+    
+    # Version 5: record which network each user's channel flags are for
+    def migrate_user_flag_networks(self):
+        self.cursor.execute("ALTER TABLE user_flags ADD COLUMN network text DEFAULT '' NOT NULL")
+        self.cursor.execute("CREATE INDEX user_flags_userid ON user_flags (userid)")
     
     def close(self):
-        self.connection.commit()
+        self.flush()
         self.connection.close()
     
+    def commit(self):
+        if self.write_batch_size is None:
+            self.connection.commit()
+            return
+        
+        self.pending_writes += 1
+        if self.pending_writes >= self.write_batch_size:
+            self.flush()
+    
+    def flush(self):
+        self.connection.commit()
+        self.pending_writes = 0
+    
     def fetch_factoid(self, subject, factoid_number):
         if factoid_number is not None:
-            factoid_number_clause = "ORDER BY factoids.id LIMIT 1 OFFSET :factoid_number"
+            offset_clause = ":factoid_number"
             params = {
-                "subject": subject,
+                "subject_key": SQLiteDatabase.subject_key(subject),
                 "factoid_number": int(factoid_number)
             }
         else:
-            factoid_number_clause = "ORDER BY RANDOM() LIMIT 1"
+            # Seek to a random position among the subject's factoids; counting and seeking both walk the
+            # (groupid, id) index, where ORDER BY RANDOM() would generate a key for every row and sort them
+            offset_clause = """
+                (RANDOM() & 9223372036854775807) % MAX((
+                    SELECT
+                        COUNT(*)
+                    FROM
+                        factoids
+                    JOIN
+                        subjects
+                    ON
+                        factoids.groupid = subjects.groupid
+                    WHERE
+                        subjects.subject_key = :subject_key
+                ), 1)
+            """
             params = {
-                "subject": subject
+                "subject_key": SQLiteDatabase.subject_key(subject)
             }
         
         self.cursor.execute("""
@@ -45,27 +197,31 @@ class SQLiteDatabase(object):
             ON
                 factoids.groupid = subjects.groupid
             WHERE
-                LOWER(subjects.subject) = LOWER(:subject)
-            {factoid_number_clause}
-        """.format(factoid_number_clause=factoid_number_clause), params)
+                subjects.subject_key = :subject_key
+            ORDER BY
+                factoids.id
+            LIMIT 1 OFFSET {offset_clause}
+        """.format(offset_clause=offset_clause), params)
         
         rows = self.cursor.fetchall()
         
         if len(rows) > 0:
             row = rows[0]
-            asynciologger = logging.getLogger('asyncio')
-            asynciologger.info("fetch_factoid " + str(row))
+            logging.getLogger('fastorbot').debug("fetch_factoid %s", row)
             
             factoid = Factoid(row["id"], row["subject"], row["separator"], row["factoid"], row["whoadded"], row["whenadded"], row["groupid"])
         else:
-            if factoid_number is not None:
-                factoid = Factoid(None, None, None, "There is no factoid number {factoid_number:d} for {subject}".format(factoid_number=factoid_number,subject=subject), None, None, 0)
-            else:
-                factoid = Factoid(None, None, None, "There are no factoids for " + subject, None, None, 0)
+            factoid = Factoid.missing(subject, factoid_number)
         
         return factoid
     
-    def fetch_random_factoid(self):
+    # Fetch every factoid for a subject in factoid number order, or None if the subject has more than max_factoids
+    def fetch_subject_factoids(self, subject, max_factoids):
+        params = {
+            "subject_key": SQLiteDatabase.subject_key(subject),
+            "limit": max_factoids + 1
+        }
+        
         self.cursor.execute("""
             SELECT
                 factoids.id,
@@ -77,19 +233,105 @@ class SQLiteDatabase(object):
                 factoids.groupid
             FROM
                 factoids
-            ORDER BY RANDOM() LIMIT 1
-        """)
+            JOIN
+                subjects
+            ON
+                factoids.groupid = subjects.groupid
+            WHERE
+                subjects.subject_key = :subject_key
+            ORDER BY
+                factoids.id
+            LIMIT :limit
+        """, params)
         
         rows = self.cursor.fetchall()
         
-        row = rows[0]
+        if len(rows) > max_factoids:
+            return None
+        
+        factoids = list()
+        
+        for row in rows:
+            factoid = Factoid(row["id"], row["subject"], row["separator"], row["factoid"], row["whoadded"], row["whenadded"], row["groupid"])
+            factoids.append(factoid)
+        
+        return factoids
+    
+    def fetch_random_factoid(self):
+        self.cursor.execute("""
+            SELECT
+                (SELECT MIN(id) FROM factoids),
+                (SELECT MAX(id) FROM factoids)
+        """)
+        
+        (min_id, max_id) = self.cursor.fetchone()
+        
+        if min_id is None:
+            return Factoid(None, None, None, "There are no factoids", None, None, 0)
+        
+        # Probe random ids in the id range, each a single primary key lookup
+        # Ids left behind by deleted factoids are retried rather than rounded to a neighbour, which keeps the choice uniform
+        row = None
+        for i in range(0, SQLiteDatabase.RANDOM_FACTOID_PROBES):
+            params = {
+                "id": random.randint(min_id, max_id)
+            }
+            
+            self.cursor.execute("""
+                SELECT
+                    factoids.id,
+                    factoids.subject,
+                    factoids.separator,
+                    factoids.factoid,
+                    factoids.whoadded,
+                    factoids.whenadded,
+                    factoids.groupid
+                FROM
+                    factoids
+                WHERE
+                    id = :id
+            """, params)
+            
+            row = self.cursor.fetchone()
+            if row is not None:
+                break
+        
+        # The id range is too sparse to hit by probing, so pick a random position in the table instead
+        if row is None:
+            self.cursor.execute("""
+                SELECT
+                    COUNT(*)
+                FROM
+                    factoids
+            """)
+            
+            params = {
+                "offset": random.randrange(self.cursor.fetchone()[0])
+            }
+            
+            self.cursor.execute("""
+                SELECT
+                    factoids.id,
+                    factoids.subject,
+                    factoids.separator,
+                    factoids.factoid,
+                    factoids.whoadded,
+                    factoids.whenadded,
+                    factoids.groupid
+                FROM
+                    factoids
+                LIMIT 1 OFFSET :offset
+            """, params)
+            
+            row = self.cursor.fetchone()
+        
         factoid = Factoid(row["id"], row["subject"], row["separator"], row["factoid"], row["whoadded"], row["whenadded"], row["groupid"])
         
         return factoid
     
     def get_factoid(self, subject, separator, factoid):
         params = {
-            "subject": subject,
+            "subject_key": SQLiteDatabase.subject_key(subject),
             "separator": separator,
             "factoid": factoid
         }
@@ -106,7 +348,7 @@ class SQLiteDatabase(object):
             FROM
                 factoids
             WHERE
-                LOWER(subject) = LOWER(:subject)
+                subject_key = :subject_key
             AND
                 separator = :separator
             AND
@@ -155,7 +397,7 @@ class SQLiteDatabase(object):
     
     def count_factoids(self, subject):
         params = {
-            "subject": subject
+            "subject_key": SQLiteDatabase.subject_key(subject)
         }
         
         self.cursor.execute("""
@@ -168,7 +410,7 @@ class SQLiteDatabase(object):
             ON
                 factoids.groupid = subjects.groupid
             WHERE
-                LOWER(subjects.subject) = LOWER(:subject)
+                subjects.subject_key = :subject_key
         """, params)
         
         rows = self.cursor.fetchall()
@@ -179,7 +421,7 @@ class SQLiteDatabase(object):
     # If there are 3 factoids for a subject, [X, Y, Z], the factoid number of X is 0, Y is 1, Z is 2
     def get_factoid_number(self, factoid):
         params = {
-            "subject": factoid.subject,
+            "subject_key": SQLiteDatabase.subject_key(factoid.subject),
             "factoid_id": factoid.id
         }
         
@@ -189,7 +431,7 @@ class SQLiteDatabase(object):
             FROM
                 factoids
             WHERE
-                LOWER(subject) = LOWER(:subject)
+                subject_key = :subject_key
             AND
                 id < :factoid_id
         """, params)
@@ -200,7 +442,7 @@ class SQLiteDatabase(object):
     
     def factoid_exists(self, subject, separator, factoid):
         params = {
-            "subject": subject,
+            "subject_key": SQLiteDatabase.subject_key(subject),
             "separator": separator,
             "factoid": factoid
         }
@@ -211,7 +453,7 @@ class SQLiteDatabase(object):
             FROM
                 factoids
             WHERE
-                LOWER(subject) = LOWER(:subject)
+                subject_key = :subject_key
             AND
                 separator = :separator
             AND
@@ -228,6 +470,7 @@ class SQLiteDatabase(object):
     def add_factoid(self, subject, separator, factoid, who_added, subject_group):
         params = {
             "subject": subject,
+            "subject_key": SQLiteDatabase.subject_key(subject),
             "separator": separator,
             "factoid": factoid,
             "whoadded": who_added,
@@ -236,14 +479,14 @@ class SQLiteDatabase(object):
         
         self.cursor.execute("""
             INSERT INTO factoids
-                (subject, separator, factoid, whoadded, groupid)
+                (subject, subject_key, separator, factoid, whoadded, groupid)
             VALUES
-                (:subject, :separator, :factoid, :whoadded, :groupid)
+                (:subject, :subject_key, :separator, :factoid, :whoadded, :groupid)
         """, params)
         
         results = self.cursor.fetchall()
         
-        self.connection.commit()
+        self.commit()
         
         return self.cursor.lastrowid
     
@@ -261,7 +504,7 @@ class SQLiteDatabase(object):
         
         results = self.cursor.fetchall()
         
-        self.connection.commit()
+        self.commit()
         
         return self.cursor.rowcount
     
@@ -290,21 +533,31 @@ class SQLiteDatabase(object):
     
     def add_subject(self, subject):
         params = {
-            "subject": subject
+            "subject": subject,
+            "subject_key": SQLiteDatabase.subject_key(subject)
         }
         
         self.cursor.execute("""
             INSERT INTO subjects
-                    (subject)
+                    (subject, subject_key)
             VALUES
-                    (:subject)
+                    (:subject, :subject_key)
         """, params)
         
         results = self.cursor.fetchall()
         
         self.initialize_group_id(subject)
         
-        self.connection.commit()
+        self.commit()
+    
+    # Look up a subject's group, adding the subject first if it doesn't exist yet
+    def get_or_add_subject_group(self, subject):
+        subject_group = self.get_subject_group(subject)
+        if subject_group is None:
+            self.add_subject(subject)
+            subject_group = self.get_subject_group(subject)
+        
+        return subject_group
     
     def initialize_group_id(self, subject):
         params = {
@@ -320,7 +573,7 @@ class SQLiteDatabase(object):
                     subject = :subject
         """, params)
         
-        self.connection.commit()
+        self.commit()
     
     def add_deny(self, subject):
         params = {
@@ -336,7 +589,7 @@ class SQLiteDatabase(object):
         
         results = self.cursor.fetchall()
         
-        self.connection.commit()
+        self.commit()
         
         return self.cursor.rowcount
     
@@ -353,7 +606,7 @@ class SQLiteDatabase(object):
         
         results = self.cursor.fetchall()
         
-        self.connection.commit()
+        self.commit()
         
         return self.cursor.rowcount
     
@@ -401,7 +654,7 @@ class SQLiteDatabase(object):
         
         if len(rows) > 0:
             row = rows[0]
-            bot_user = BotUser(row["id"], row["username"], row["userlevel"], row["host"])
+            bot_user = BotUser(row["id"], row["username"], row["flags"], row["host"])
         else:
             bot_user = None
         
@@ -431,19 +684,8 @@ class SQLiteDatabase(object):
         
         return salt
     
-    def gen_user_key(self, password, salt):
-        user_key = hashlib.pbkdf2_hmac("sha512", password.encode(), bytes.fromhex(salt), 500000)
-        return user_key.hex()
-    
-    def identify(self, username, password):
-        salt = self.get_user_salt(username)
-        
-        if salt is None:
-            return None
-        
-        # Generate the hash and check the database
-        user_key = self.gen_user_key(password, salt)
-        
+    # The user key must be derived from the password and the user's salt with PasswordHasher
+    def identify(self, username, user_key):
         params = {
             "username": username,
             "password": user_key
@@ -473,29 +715,26 @@ class SQLiteDatabase(object):
         
         return bot_user
     
-    def set_user_host(self, user_id, hostmask):
+    def set_user_host(self, user_id, hostmask, network):
         params = {
             "id": user_id,
-            "hostmask": hostmask
+            "hostmask": hostmask,
+            "network": network
         }
         
         self.cursor.execute("""
             UPDATE
                 users
             SET
-                hosts = :hostmask
+                hosts = :hostmask,
+                network = :network
             WHERE
                 id = :id
         """, params)
         
-        self.connection.commit()
+        self.commit()
     
-    def add_user(self, username, password, flags):
-        # Generate a salt and hash the password
-        salt = os.urandom(32).hex()
-        
-        user_key = self.gen_user_key(password, salt)
-        
+    def add_user(self, username, user_key, salt, flags):
         params = {
             "username": username,
             "password": user_key,
@@ -512,7 +751,7 @@ class SQLiteDatabase(object):
         
         new_id = self.cursor.lastrowid
         
-        self.connection.commit()
+        self.commit()
         
         return new_id
     
@@ -521,6 +760,20 @@ class SQLiteDatabase(object):
             "username": username
         }
         
+        self.cursor.execute("""
+            DELETE FROM
+                user_masks
+            WHERE
+                userid IN (SELECT id FROM users WHERE username = :username)
+        """, params)
+        
+        self.cursor.execute("""
+            DELETE FROM
+                user_flags
+            WHERE
+                userid IN (SELECT id FROM users WHERE username = :username)
+        """, params)
+        
         self.cursor.execute("""
             DELETE FROM
                 users
@@ -528,18 +781,11 @@ class SQLiteDatabase(object):
                 username = :username
         """, params)
         
-        self.connection.commit()
+        self.commit()
         
         return self.cursor.rowcount
     
-    def change_password(self, username, oldpass, newpass):
-        salt = self.get_user_salt(username)
-        if salt is None:
-            return None
-        
-        old_key = self.gen_user_key(oldpass, salt)
-        new_key = self.gen_user_key(newpass, salt)
-        
+    def change_password(self, username, old_key, new_key):
         params = {
             "username": username,
             "oldpass": old_key,
@@ -557,19 +803,23 @@ class SQLiteDatabase(object):
                 userpass = :oldpass
         """, params)
         
-        self.connection.commit()
+        self.commit()
         
         return self.cursor.rowcount
     
+    # Returns a list of tuples (network, BotUser)
     def get_identified_users(self):
         self.cursor.execute("""
             SELECT
                 id,
                 username,
                 userlevel AS flags,
-                hosts AS hostmask
+                hosts AS hostmask,
+                network
             FROM
                 users
+            WHERE
+                hosts != ''
         """)
         
         rows = self.cursor.fetchall()
@@ -578,10 +828,129 @@ class SQLiteDatabase(object):
         
         for row in rows:
             bot_user = BotUser(row[0], row[1], row[2], row[3])
-            identified_users.append(bot_user)
+            identified_users.append((row[4], bot_user))
         
         return identified_users
     
+    def add_user_mask(self, user_id, mask, network):
+        params = {
+            "id": user_id,
+            "mask": mask,
+            "network": network
+        }
+        
+        self.cursor.execute("""
+            INSERT INTO user_masks
+                    (userid, mask, network)
+            VALUES
+                    (:id, :mask, :network)
+        """, params)
+        
+        self.commit()
+    
+    def remove_user_mask(self, user_id, mask, network):
+        params = {
+            "id": user_id,
+            "mask": mask,
+            "network": network
+        }
+        
+        self.cursor.execute("""
+            DELETE FROM
+                user_masks
+            WHERE
+                userid = :id
+            AND
+                mask = :mask
+            AND
+                network = :network
+        """, params)
+        
+        self.commit()
+        
+        return self.cursor.rowcount
+    
+    # Returns a list of tuples (network, mask, BotUser)
+    def get_user_masks(self):
+        self.cursor.execute("""
+            SELECT
+                users.id,
+                users.username,
+                users.userlevel AS flags,
+                users.hosts AS hostmask,
+                user_masks.mask,
+                user_masks.network
+            FROM
+                user_masks
+            JOIN
+                users ON users.id = user_masks.userid
+            ORDER BY
+                user_masks.id
+        """)
+        
+        rows = self.cursor.fetchall()
+        
+        user_masks = list()
+        
+        for row in rows:
+            bot_user = BotUser(row[0], row[1], row[2], row[3])
+            user_masks.append((row[5], row[4], bot_user))
+        
+        return user_masks
+    
+    # Replaces the user's flags for the channel; empty flags remove them
+    def set_user_channel_flags(self, user_id, channel, flags, network):
+        params = {
+            "id": user_id,
+            "channel": channel,
+            "flags": flags,
+            "network": network
+        }
+        
+        self.cursor.execute("""
+            DELETE FROM
+                user_flags
+            WHERE
+                userid = :id
+            AND
+                channel = :channel
+            AND
+                network = :network
+        """, params)
+        
+        if flags != "":
+            self.cursor.execute("""
+                INSERT INTO user_flags
+                        (userid, channel, flags, network)
+                VALUES
+                        (:id, :channel, :flags, :network)
+            """, params)
+        
+        self.commit()
+    
+    # Returns a list of tuples (network, user id, channel, flags)
+    def get_user_channel_flags(self):
+        self.cursor.execute("""
+            SELECT
+                user_flags.network,
+                user_flags.userid,
+                user_flags.channel,
+                user_flags.flags
+            FROM
+                user_flags
+            JOIN
+                users ON users.id = user_flags.userid
+        """)
+        
+        rows = self.cursor.fetchall()
+        
+        user_channel_flags = list()
+        
+        for row in rows:
+            user_channel_flags.append((row[0], row[1], row[2], row[3]))
+        
+        return user_channel_flags
+    
     def add_ignore(self, nick, host, endtime, whoignored):
         
         params = {
@@ -598,7 +967,7 @@ class SQLiteDatabase(object):
                     (:nick, :host, :endtime, :whoignored)
         """, params)
         
-        self.connection.commit()
+        self.commit()
         
         return self.cursor.rowcount
     
@@ -618,7 +987,7 @@ class SQLiteDatabase(object):
                 hostmask = :host
         """, params)
         
-        self.connection.commit()
+        self.commit()
         
         return self.cursor.rowcount
     
@@ -635,7 +1004,7 @@ class SQLiteDatabase(object):
             WHERE
                 hostmask = :host
             AND
-                endtime > CURRENT_TIMESTAMP
+                endtime > CAST(strftime('%s', 'now') AS integer)
         """, params)
         
         results = self.cursor.fetchall()
@@ -646,3 +1015,23 @@ class SQLiteDatabase(object):
             return False
         else:
             return True
+    
+    def get_active_ignores(self):
+        self.cursor.execute("""
+            SELECT
+                hostmask,
+                endtime
+            FROM
+                ignores
+            WHERE
+                endtime > CAST(strftime('%s', 'now') AS integer)
+        """)
+        
+        rows = self.cursor.fetchall()
+        
+        ignores = list()
+        
+        for row in rows:
+            ignores.append((row["hostmask"], row["endtime"]))
+        
+        return ignores
@@ -1,3 +1,5 @@
+PRAGMA user_version = 5;
+
 CREATE TABLE auto_bans (
     id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
     host text NOT NULL,
@@ -24,6 +26,7 @@ CREATE TABLE denies (
 CREATE TABLE factoids (
     id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
     subject text NOT NULL,
+    subject_key text DEFAULT '' NOT NULL,
     separator text NOT NULL,
     factoid text NOT NULL,
     whoadded text NOT NULL,
@@ -48,6 +51,7 @@ CREATE TABLE ignores (
 CREATE TABLE subjects (
     id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
     subject text NOT NULL,
+    subject_key text DEFAULT '' NOT NULL,
     groupid integer DEFAULT 0 NOT NULL
 );
 
@@ -55,7 +59,15 @@ CREATE TABLE user_flags (
     id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
     userid integer NOT NULL,
     channel text NOT NULL,
-    flags text NOT NULL
+    flags text NOT NULL,
+    network text DEFAULT '' NOT NULL
+);
+
+CREATE TABLE user_masks (
+    id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+    userid integer NOT NULL,
+    mask text NOT NULL,
+    network text DEFAULT '' NOT NULL
 );
 
 CREATE TABLE user_messages (
@@ -75,7 +87,22 @@ CREATE TABLE users (
     userlevel text NOT NULL,
     hosts text DEFAULT '' NOT NULL,
     autovoice text,
-    autoop text
+    autoop text,
+    network text DEFAULT '' NOT NULL
 );
 
+CREATE INDEX denies_subject ON denies (subject);
+
+CREATE INDEX factoids_subject_key_id ON factoids (subject_key, id);
+
+CREATE INDEX factoids_groupid_id ON factoids (groupid, id);
+
+CREATE INDEX subjects_subject_key ON subjects (subject_key);
+
+CREATE INDEX user_flags_userid ON user_flags (userid);
+
+CREATE UNIQUE INDEX user_masks_network_mask ON user_masks (network, mask);
+
+CREATE INDEX user_masks_userid ON user_masks (userid);
+
 INSERT INTO users (username, userpass, userlevel, hosts) VALUES ('admin', '200ceb26807d6bf99fd6f4f0d1ca54d4', 'abdegmnos', '');
\ No newline at end of file
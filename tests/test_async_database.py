@@ -0,0 +1,80 @@
+import asyncio
+import functools
+import os
+import sqlite3
+import threading
+
+import pytest
+
+from fastorbot.AsyncDatabase import *
+from fastorbot.MetricsRegistry import *
+from fastorbot.SQLiteDatabase import *
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sqlite_database_schema.sql")
+
+# Creates an empty database from the schema, leaving out the default admin user, and opens it with a reader connection
+def open_database(tmp_path, write_batch_size=None, flush_interval=None, metrics=None):
+    dsn = str(tmp_path / "fastorbot.db")
+    
+    with open(SCHEMA_PATH) as schema_file:
+        schema = schema_file.read().split("INSERT INTO users")[0]
+    
+    connection = sqlite3.connect(dsn)
+    connection.executescript(schema)
+    connection.close()
+    
+    return AsyncDatabase(functools.partial(SQLiteDatabase, dsn, write_batch_size), functools.partial(SQLiteDatabase, dsn, None, None, True), flush_interval, None, metrics)
+
+# Queries the reader connection directly, to see what a read routed there would get
+def read_from_reader(db, method_name, *args):
+    return db.run_in_executor(db.reader_executor, db.reader, method_name, args)
+
+@pytest.mark.parametrize("metrics", [None, MetricsRegistry()], ids=["no_metrics", "metrics"])
+def test_read_after_timed_out_write_goes_to_writer(tmp_path, metrics):
+    db = open_database(tmp_path, metrics=metrics)
+    
+    # Hold up the writer so the write is still queued when its caller gives up
+    writer_released = threading.Event()
+    
+    async def run():
+        db.executor.submit(writer_released.wait)
+        
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(db.add_user("bob", "key", "salt", "a"), 0.05)
+        
+        assert db.writes_in_flight == 1
+        
+        read = db.get_user_by_name("bob")
+        writer_released.set()
+        bot_user = await read
+        
+        assert (bot_user is not None) and (bot_user.username == "bob")
+        assert db.writes_in_flight == 0
+    
+    try:
+        asyncio.run(run())
+    finally:
+        writer_released.set()
+        db.close()
+
+def test_read_before_flush_goes_to_writer(tmp_path):
+    # The flush interval is long enough that only the explicit flush() commits
+    db = open_database(tmp_path, write_batch_size=50, flush_interval=60)
+    
+    async def run():
+        try:
+            await db.add_user("bob", "key", "salt", "a")
+            
+            assert db.writes_unflushed == 1
+            assert await read_from_reader(db, "get_user_by_name", "bob") is None
+            assert (await db.get_user_by_name("bob")).username == "bob"
+            
+            await db.flush()
+            
+            assert db.writes_unflushed == 0
+            assert (await read_from_reader(db, "get_user_by_name", "bob")).username == "bob"
+        finally:
+            # Closed on the loop, so the pending flush timer can be cancelled
+            db.close()
+    
+    asyncio.run(run())
@@ -0,0 +1,27 @@
+import asyncio
+
+import pytest
+
+from fastorbot.CommandScheduler import *
+
+def test_slow_command_raises_command_timeout():
+    command_scheduler = CommandScheduler(timeout=0.05)
+    
+    async def slow_command():
+        await asyncio.sleep(10)
+    
+    with pytest.raises(CommandTimeout):
+        asyncio.run(command_scheduler.run("#channel", slow_command))
+    
+    assert len(command_scheduler.semaphores) == 0
+
+def test_timeout_inside_command_is_not_a_command_timeout():
+    command_scheduler = CommandScheduler(timeout=10)
+    
+    async def command_with_own_timeout():
+        await asyncio.wait_for(asyncio.sleep(10), 0.01)
+    
+    with pytest.raises(asyncio.TimeoutError) as exception_info:
+        asyncio.run(command_scheduler.run("#channel", command_with_own_timeout))
+    
+    assert not isinstance(exception_info.value, CommandTimeout)
@@ -0,0 +1,77 @@
+import pytest
+
+from fastorbot.LameNick import *
+
+# (nick, lameness points, lameness rating) from the scorer as it was written in Fastorbot.command_lamenick, before it
+# moved to LameNick
+GOLDEN_SCORES = [
+    ('a', 0, 0.0),
+    ('A', 0, 0.0),
+    ('fastorbot', 0, 0.0),
+    ('smlerman', 0, 0.0),
+    ('sm1erman', 144, 0.0),
+    ('Guest12345', 120, 0.0),
+    ('xXx_DeAtH_xXx', 3649, 32.63),
+    ('[Flash]Gordon', 2280, 16.01),
+    ('ChoboKing69', 100000000000000000000, 100.0),
+    ('some_long_nickname_here', 9961, 67.37),
+    ('[]{}()', 13302, 74.55),
+    ('^^^', 4495, 40.64),
+    ('__init__', 5782, 50.02),
+    ('\\o/', 2695, 21.47),
+    ('l33t', 144, 0.0),
+    ('123abc', 293, 0.0),
+    ('abc123', 120, 0.0),
+    ('aBcDeF', 124, 0.0),
+    ('ABCdef', 220, 0.0),
+    ('NightLord', 86, 0.0),
+    ('n1te_k1ng', 2717, 21.75),
+    ('darkdeath', 1000, 1.56),
+    ('fuckshit', 10000, 67.48),
+    ('c00l_dude', 2404, 17.66),
+    ('kewl', 1000, 1.56),
+    ('lamer', 500, 0.07),
+    ('d00d', 1644, 7.69),
+    ('doodz', 1500, 6.0),
+    ('roolz', 1500, 6.0),
+    ('rulez', 1000, 1.56),
+    ('l00ser', 144, 0.0),
+    ('luser', 1000, 1.56),
+    ('1eet', 1740, 8.88),
+    ('e1ite', 894, 1.0),
+    ('pr0n', 644, 0.23),
+    ('warez', 2500, 18.93),
+    ('xxx', 250, 0.0),
+    ('r0x0r', 2207, 15.03),
+    ('Kx0', 620, 0.19),
+    ('CHOBO', 100000000000000000000, 100.0),
+    ('cHoBo', 100000000000000000000, 100.0),
+    ('é', 1525, 6.28),
+    ('Émile', 1650, 7.76),
+    ('straße', 1260, 3.54),
+    ('naïve_ÜBER', 4702, 42.35),
+    ('日本語', 4495, 40.64),
+    ('😀nick', 1650, 7.76),
+    ('nick😀', 1225, 3.22),
+    ('٣abc', 1770, 9.26),
+    ('1٣x', 1404, 4.95),
+    ('۵', 1645, 7.7),
+    ('०१२nick', 4568, 41.26),
+    ('nick٣', 1225, 3.22),
+    ('０９nick', 2929, 24.41),
+    ('²abc', 1650, 7.76),
+    ('𝟘x', 1770, 9.26),
+    ('Ⅻ', 1525, 6.28),
+    ('12٣45', 1509, 6.1),
+]
+
+@pytest.mark.parametrize("nick, points, rating", GOLDEN_SCORES)
+def test_calculate_score_matches_original_scorer(nick, points, rating):
+    assert LameNick().calculate_score(nick) == (points, rating)
+
+def test_get_score_is_cached():
+    lame_nick = LameNick(cache_size=2)
+    
+    assert lame_nick.get_score("xXx_DeAtH_xXx") == (3649, 32.63)
+    assert lame_nick.get_score("xXx_DeAtH_xXx") == (3649, 32.63)
+    assert lame_nick.get_score.cache_info().hits == 1